@@ -0,0 +1,120 @@
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Keystone tokens and service catalogs cached between runs """
+
+import hashlib
+import hmac
+import os
+import threading
+
+import keystoneclient.access
+import keystoneclient.v2_0.client
+
+from tempest_report import storage
+
+
+# Cached tokens expiring within this number of seconds are not reused
+STALE_DURATION = 300
+
+# PBKDF2 iterations of the password digest stored with a token
+PASSWORD_ITERATIONS = 20000
+
+
+class TokenCache(object):
+    """ Authentication responses (token and service catalog) stored in a
+    JSON file, keyed by auth URL, user and tenant. A token is only reused
+    with the password it was requested with, which is checked against a
+    salted PBKDF2 digest stored with the token. """
+
+    def __init__(self, path, stale_duration=STALE_DURATION):
+        self.path = path
+        self.stale_duration = stale_duration
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(auth_url, username, tenant_name=None):
+        ident = '|'.join([auth_url or '', username or '', tenant_name or ''])
+        return hashlib.sha1(ident).hexdigest()
+
+    @staticmethod
+    def digest(password, salt):
+        return hashlib.pbkdf2_hmac('sha256', password or '', salt,
+                                   PASSWORD_ITERATIONS).encode('hex')
+
+    def expired(self, entry):
+        try:
+            access = keystoneclient.access.AccessInfo.factory(
+                **entry['auth_ref'])
+            return access.will_expire_soon(self.stale_duration)
+        except Exception:
+            return True
+
+    def get(self, auth_url, username, password, tenant_name=None):
+        """ Return a cached auth_ref, None if missing, about to expire or
+        requested with another password """
+        with self.lock:
+            entries = storage.load_json(self.path, {})
+        entry = entries.get(self.key(auth_url, username, tenant_name))
+        if not entry or self.expired(entry):
+            return None
+        digest = self.digest(password, entry['salt'].decode('hex'))
+        if not hmac.compare_digest(digest, str(entry['digest'])):
+            return None
+        return entry['auth_ref']
+
+    def add(self, auth_url, username, password, tenant_name, auth_ref):
+        """ Store an auth_ref and drop all expired entries """
+        salt = os.urandom(16)
+        entry = {'auth_ref': dict(auth_ref),
+                 'salt': salt.encode('hex'),
+                 'digest': self.digest(password, salt)}
+        with self.lock:
+            entries = storage.load_json(self.path, {})
+            entries[self.key(auth_url, username, tenant_name)] = entry
+            entries = dict((key, value) for key, value in entries.items()
+                           if not self.expired(value))
+            storage.save_json(self.path, entries)
+
+    def client(self, username, password, auth_url, tenant_name=None):
+        """ Return a keystone client, authenticating only if there is no
+        valid cached token """
+        auth_ref = self.get(auth_url, username, password, tenant_name)
+        if auth_ref:
+            return keystoneclient.v2_0.client.Client(username=username,
+                                                     password=password,
+                                                     auth_url=auth_url,
+                                                     tenant_name=tenant_name,
+                                                     auth_ref=auth_ref)
+
+        keystone = keystoneclient.v2_0.client.Client(username=username,
+                                                     password=password,
+                                                     auth_url=auth_url,
+                                                     tenant_name=tenant_name)
+        # Unscoped tokens have no catalog and can't be reused by the client
+        if keystone.auth_ref.scoped:
+            self.add(auth_url, username, password, tenant_name,
+                     keystone.auth_ref)
+        return keystone
+
+
+def get_client(username, password, auth_url, tenant_name=None,
+               token_cache=None):
+    """ Return a keystone client, using the token cache if given """
+    if token_cache is not None:
+        return token_cache.client(username, password, auth_url, tenant_name)
+    return keystoneclient.v2_0.client.Client(username=username,
+                                             password=password,
+                                             auth_url=auth_url,
+                                             tenant_name=tenant_name)
@@ -15,70 +15,118 @@
 # under the License.
 
 import ConfigParser
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import optparse
 import StringIO
 import sys
 import tempfile
+import time
 
-import keystoneclient.v2_0.client as keystone_client
-import neutronclient.common.clientmanager
-import novaclient.client
-import novaclient
+import requests
 
+from tempest_report import auth
+from tempest_report import storage
 
-def get_smallest_flavor(user, password, tenant_name, url, region_name=None):
-    client_class = novaclient.client.get_client_class(2)
-    nova_client = client_class(
-        user, password, tenant_name, url, region_name=region_name)
+
+# Number of pooled connections per host and timeout in seconds of requests
+POOL_SIZE = 10
+TIMEOUT = 60
+
+# Timeout in seconds of a single discovery probe
+PROBE_TIMEOUT = 120
+
+
+class EndpointNotFound(Exception):
+    pass
+
+
+class DiscoveryContext(object):
+    """ Authenticates once and shares the token, the service catalog and a
+    pooled HTTP session between all discovery probes. """
+
+    def __init__(self, user, password, tenant_name, auth_url,
+                 region_name=None, token_cache=None):
+        self.auth_url = auth_url
+        self.region_name = region_name
+
+        keystone = auth.get_client(user, password, auth_url, tenant_name,
+                                   token_cache)
+        self.token = keystone.auth_ref['token']['id']
+        self.catalog = keystone.auth_ref['serviceCatalog']
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE,
+                                                pool_maxsize=POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @property
+    def services(self):
+        return get_endpoints(self.catalog)
+
+    def endpoint(self, service_type, interface='publicURL'):
+        """ Return the endpoint of a service in the selected region """
+        for service in self.catalog:
+            if service['type'] != service_type:
+                continue
+            for endpoint in service['endpoints']:
+                if (not self.region_name or
+                        endpoint.get('region') == self.region_name):
+                    return endpoint[interface]
+        raise EndpointNotFound(service_type)
+
+    def get(self, service_type, path, interface='publicURL'):
+        """ GET a path relative to the endpoint of a service and return the
+        decoded JSON response """
+        url = "%s/%s" % (self.endpoint(service_type, interface).rstrip('/'),
+                         path)
+        response = self.session.get(url,
+                                    headers={'X-Auth-Token': self.token,
+                                             'Accept': 'application/json'},
+                                    timeout=TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+
+
+def get_smallest_flavor(context):
     try:
-        flavors = nova_client.flavors.list()
-    except novaclient.exceptions.EndpointNotFound:
+        flavors = context.get('compute', 'flavors/detail')['flavors']
+    except EndpointNotFound:
         return None
 
     if flavors:
         smallest_flavor = flavors[0]
         for flavor in flavors:
-            if flavor.vcpus <= smallest_flavor.vcpus:
-                if flavor.disk <= smallest_flavor.disk:
-                    if flavor.ram < smallest_flavor.ram:
+            if flavor['vcpus'] <= smallest_flavor['vcpus']:
+                if flavor['disk'] <= smallest_flavor['disk']:
+                    if flavor['ram'] < smallest_flavor['ram']:
                         smallest_flavor = flavor
-        return smallest_flavor.id
+        return smallest_flavor['id']
 
 
-def get_smallest_image(user, password, tenant_name, url, region_name=None):
-    client_class = novaclient.client.get_client_class(2)
-    nova_client = client_class(
-        user, password, tenant_name, url, region_name=region_name)
+def get_smallest_image(context):
     try:
-        images = nova_client.images.list()
-    except novaclient.exceptions.EndpointNotFound:
+        images = context.get('compute', 'images/detail')['images']
+    except EndpointNotFound:
         return None
 
     min_size = sys.maxint
     smallest_image = None
     for img in images:
-        size = img._info.get('OS-EXT-IMG-SIZE:size', sys.maxint)
-        if img.status == 'ACTIVE' and size < min_size:
+        size = img.get('OS-EXT-IMG-SIZE:size', sys.maxint)
+        if img['status'] == 'ACTIVE' and size < min_size:
             min_size = size
             smallest_image = img
     if smallest_image:
-        return smallest_image.id
-
+        return smallest_image['id']
 
-def get_external_network_id(auth_url, username, password, tenant_name):
-    client_manager = neutronclient.common.clientmanager.ClientManager(
-        auth_url=auth_url,
-        username=username,
-        password=password,
-        tenant_name=tenant_name,
-        auth_strategy="keystone",
-        endpoint_type='publicURL',
-        api_version={'network': '2.0'}
-    )
 
+def get_external_network_id(context):
     try:
-        networks = client_manager.neutron.list_networks().get('networks', {})
+        networks = context.get('network', 'v2.0/networks').get('networks', [])
     except Exception:
         networks = []
 
@@ -88,14 +136,10 @@ def get_external_network_id(auth_url, username, password, tenant_name):
     return None
 
 
-def get_services(user, password, tenant_name, keystone_url):
-    keystone = keystone_client.Client(auth_url=keystone_url,
-                                      username=user,
-                                      password=password,
-                                      tenant_name=tenant_name)
-
+def get_endpoints(service_catalog):
+    """ Return the first public endpoint of every service type """
     services = {}
-    for service in keystone.auth_ref['serviceCatalog']:
+    for service in service_catalog:
         service_type = service['type']
         endpoint = service['endpoints'][0]['publicURL']
         if service_type not in services:
@@ -103,39 +147,43 @@ def get_services(user, password, tenant_name, keystone_url):
     return services
 
 
-def customized_tempest_conf(users,
-                            keystone_url,
-                            image_id=None,
-                            region_name=None,
-                            flavor_id=None):
-    user = users['admin_user']['username']
-    password = users['admin_user']['password']
-    tenant_name = users['admin_user']['tenant_name']
+def get_services(context):
+    return context.services
 
-    if not flavor_id:
-        flavor_id = get_smallest_flavor(
-            user, password, tenant_name, keystone_url, region_name)
 
-    if not image_id:
-        image_id = get_smallest_image(
-            user, password, tenant_name, keystone_url, region_name)
+def run_probes(probes, timeout=PROBE_TIMEOUT):
+    """ Run discovery probes concurrently.
 
+    probes maps a name to a tuple (function, args, default). Returns a dict
+    with the result of every probe, or its default if the probe failed or
+    didn't finish within timeout seconds, which is logged as a warning. """
+    logger = logging.getLogger('tempest_report')
+    pool = ThreadPool(len(probes))
     try:
-        network_id = get_external_network_id(keystone_url, user,
-                                             password, tenant_name)
-    except Exception:
-        network_id = 0
-
-    tempest_config = ConfigParser.SafeConfigParser()
-
-    tempest_config.set('DEFAULT', 'debug', 'False')
-    tempest_config.set('DEFAULT', 'use_stderr', 'False')
-    tempest_config.set('DEFAULT', 'log_file', 'tempest.log')
-    tempest_config.set('DEFAULT', 'lock_path', '/tmp')
-
-    tempest_config.add_section('identity')
-    tempest_config.set('identity', 'uri', keystone_url)
-
+        pending = dict((name, pool.apply_async(function, args))
+                       for name, (function, args, _) in probes.items())
+        deadline = time.time() + timeout
+        results = {}
+        for name, async_result in pending.items():
+            try:
+                results[name] = async_result.get(
+                    max(0, deadline - time.time()))
+            except multiprocessing.TimeoutError:
+                logger.warning("Discovery probe %s timed out after %gs, "
+                               "using %r" % (name, timeout, probes[name][2]))
+                results[name] = probes[name][2]
+            except Exception, error:
+                logger.warning("Discovery probe %s failed, using %r: %s" %
+                               (name, probes[name][2], error))
+                results[name] = probes[name][2]
+    finally:
+        # Don't wait for probes that timed out
+        pool.terminate()
+    return results
+
+
+def set_users(tempest_config, users):
+    """ Set the admin, first and second user of a tempest config """
     tempest_config.set('identity', 'username',
                        users['first_user']['username'])
     tempest_config.set('identity', 'alt_username',
@@ -159,6 +207,67 @@ def customized_tempest_conf(users,
     tempest_config.set('identity', 'admin_role', '"%s"' %
                        users['admin_user']['tenant_name'])
 
+    if users['first_user'] != users['second_user']:
+        tempest_config.set('compute', 'allow_tenant_isolation', "True")
+        tempest_config.set('compute', 'allow_tenant_reuse', "True")
+    else:
+        tempest_config.set('compute', 'allow_tenant_isolation', "False")
+        tempest_config.set('compute', 'allow_tenant_reuse', "False")
+
+
+def config_for_users(content, users):
+    """ Return the content of a tempest config with other users, without
+    discovering the cloud again """
+    tempest_config = ConfigParser.SafeConfigParser()
+    tempest_config.readfp(StringIO.StringIO(content))
+    set_users(tempest_config, users)
+    fileobj = StringIO.StringIO()
+    tempest_config.write(fileobj)
+    return fileobj.getvalue()
+
+
+def customized_tempest_conf(users,
+                            keystone_url,
+                            image_id=None,
+                            region_name=None,
+                            flavor_id=None,
+                            context=None,
+                            token_cache=None):
+    """ Return the content of a tempest config for the given users.
+
+    All probes run concurrently and authenticate with the admin user through
+    a DiscoveryContext, which is created if not given. """
+    if context is None:
+        context = DiscoveryContext(users['admin_user']['username'],
+                                   users['admin_user']['password'],
+                                   users['admin_user']['tenant_name'],
+                                   keystone_url,
+                                   region_name,
+                                   token_cache)
+
+    probes = {'network_id': (get_external_network_id, (context, ), 0),
+              'services': (get_services, (context, ), {})}
+    if not flavor_id:
+        probes['flavor_id'] = (get_smallest_flavor, (context, ), None)
+    if not image_id:
+        probes['image_id'] = (get_smallest_image, (context, ), None)
+
+    results = run_probes(probes)
+    flavor_id = flavor_id or results.get('flavor_id')
+    image_id = image_id or results.get('image_id')
+    network_id = results['network_id']
+    services = results['services']
+
+    tempest_config = ConfigParser.SafeConfigParser()
+
+    tempest_config.set('DEFAULT', 'debug', 'False')
+    tempest_config.set('DEFAULT', 'use_stderr', 'False')
+    tempest_config.set('DEFAULT', 'log_file', 'tempest.log')
+    tempest_config.set('DEFAULT', 'lock_path', '/tmp')
+
+    tempest_config.add_section('identity')
+    tempest_config.set('identity', 'uri', keystone_url)
+
     tempest_config.add_section('identity-feature-enabled')
     tempest_config.set('identity-feature-enabled', 'api_v3', 'False')
     tempest_config.set('identity', 'uri_v3', '')
@@ -177,12 +286,7 @@ def customized_tempest_conf(users,
         tempest_config.set('identity', 'region', region_name)
         tempest_config.set('compute', 'region', region_name)
 
-    if users['first_user'] != users['second_user']:
-        tempest_config.set('compute', 'allow_tenant_isolation', "True")
-        tempest_config.set('compute', 'allow_tenant_reuse', "True")
-    else:
-        tempest_config.set('compute', 'allow_tenant_isolation', "False")
-        tempest_config.set('compute', 'allow_tenant_reuse', "False")
+    set_users(tempest_config, users)
 
     if network_id is not None:
         tempest_config.add_section('network')
@@ -195,10 +299,9 @@ def customized_tempest_conf(users,
                     ('network', 'neutron'),
                     ]
 
-    services = get_services(user, password, tenant_name, keystone_url)
     if not image_id:
-        del services['compute']
-        del services['image']
+        services.pop('compute', None)
+        services.pop('image', None)
     tempest_config.add_section('service_available')
     for service, name in run_services:
         run = "True" if services.get(service) else "False"
@@ -216,6 +319,7 @@ usage: %%prog
              [--os-password <auth-password>]
              [--os-auth-url <auth-url>]
              [--os-tenant-name <auth-tenant-name>]
+             [--token-cache <file>] [--no-token-cache]
 
 Command-line interface for OpenStack Tempest.
 
@@ -245,6 +349,13 @@ Examples:
                       default=os.environ.get('OS_REGION_NAME'),
                       help='Openstack tenant name. '
                            'Defaults to env[OS_REGION_NAME].')
+    parser.add_option('--token-cache', dest="token_cache",
+                      default=storage.state_path('tokens.json'),
+                      help='File caching Keystone tokens and service '
+                           'catalogs between runs. '
+                           'Defaults to ~/.tempest-report/tokens.json')
+    parser.add_option('--no-token-cache', action="store_const", const=None,
+                      dest="token_cache", help='Always request a new token')
 
     (options, args) = parser.parse_args()
 
@@ -254,11 +365,16 @@ Examples:
         parser.print_usage()
         sys.exit(1)
 
+    token_cache = None
+    if options.token_cache:
+        token_cache = auth.TokenCache(options.token_cache)
+
     tenant_name = options.os_tenant_name
     if tenant_name is None:
-        keystone = keystone_client.Client(username=options.os_username,
-                                          password=options.os_password,
-                                          auth_url=options.os_auth_url)
+        keystone = auth.get_client(options.os_username,
+                                   options.os_password,
+                                   options.os_auth_url,
+                                   token_cache=token_cache)
         tenants = keystone.tenants.findall()
         if len(tenants) > 1:
             print "Found %d tenants, using %s for current job." % (
@@ -273,7 +389,8 @@ Examples:
                        'tenant_name': tenant_name}
 
     config = customized_tempest_conf(
-        users, options.os_auth_url, region_name=options.os_region_name)
+        users, options.os_auth_url, region_name=options.os_region_name,
+        token_cache=token_cache)
 
     configfile = tempfile.NamedTemporaryFile(
         prefix='tempest_conf_', delete=False)
@@ -0,0 +1,152 @@
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Matching of test names against the lines of an exclude file.
+
+Most lines are plain (partial) test names. These are searched all at once
+with an Aho-Corasick automaton, the remaining regular expressions are
+combined into a single alternation. """
+
+import collections
+import re
+
+
+# Lines only made of these characters are matched as plain strings. A dot
+# in such a line matches a dot or the colon between module and class.
+LITERAL_LINE = re.compile(r'^[\w.:/-]+$')
+
+
+def canonical_name(name):
+    return name.replace(':', '.')
+
+
+class AhoCorasick(object):
+    """ Finds all occurrences of a list of strings in a single pass """
+
+    def __init__(self, strings):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+
+        for index, string in enumerate(strings):
+            state = 0
+            for char in string:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.output[state] += (index, )
+
+        # Breadth-first, so the failure state of every parent is known
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.output[next_state] += self.output[self.fail[next_state]]
+
+    def search(self, text):
+        """ Return the indexes of all strings occurring in text """
+        found = set()
+        state = 0
+        goto, fail, output = self.goto, self.fail, self.output
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+class ExcludeMatcher(object):
+    """ Compiled lines of an exclude file.
+
+    lines is a list of (line number, pattern) tuples. The tests matched by
+    every line are recorded for the exclude report. """
+
+    def __init__(self, lines=None):
+        self.lines = list(lines or [])
+        self.matches = collections.defaultdict(list)
+
+        self.literals = []
+        self.regexps = []
+        # Groups would be renumbered in the alternation, these are tested
+        # one by one
+        self.grouped_regexps = []
+        for lineno, pattern in self.lines:
+            if LITERAL_LINE.match(pattern):
+                self.literals.append((lineno, pattern))
+                continue
+            regex = re.compile(pattern)
+            if regex.groups:
+                self.grouped_regexps.append((lineno, regex))
+            else:
+                self.regexps.append((lineno, regex))
+
+        self.automaton = AhoCorasick([canonical_name(pattern)
+                                      for _lineno, pattern in self.literals])
+        self.combined = None
+        if self.regexps:
+            self.combined = re.compile('|'.join(
+                '(?:%s)' % regex.pattern for _lineno, regex in self.regexps))
+
+    @classmethod
+    def from_file(cls, fname):
+        lines = []
+        with open(fname) as exclude_file:
+            for lineno, line in enumerate(exclude_file, 1):
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    lines.append((lineno, line))
+        return cls(lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def match(self, testname):
+        """ Return the number of the first line matching testname, or None
+        if the test isn't excluded """
+        matched = [self.literals[index][0] for index in
+                   self.automaton.search(canonical_name(testname))]
+        matched.extend(lineno for lineno, regex in self.grouped_regexps
+                       if regex.search(testname))
+        # Find out which regex matched only if the alternation matches
+        if self.combined is not None and self.combined.search(testname):
+            matched.extend(lineno for lineno, regex in self.regexps
+                           if regex.search(testname))
+        if not matched:
+            return None
+        lineno = min(matched)
+        self.matches[lineno].append(testname)
+        return lineno
+
+    def report(self):
+        """ Return a report of the tests excluded by every line, including
+        the lines that didn't match any test """
+        report = []
+        for lineno, pattern in self.lines:
+            tests = self.matches.get(lineno, [])
+            report.append("# line %d: %s (%d tests%s)" % (
+                lineno, pattern, len(tests), '' if tests else ', unused'))
+            report.extend(tests)
+        return '\n'.join(report) + '\n'
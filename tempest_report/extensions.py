@@ -0,0 +1,83 @@
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Fast discovery of extensions and meters through the REST APIs.
+
+Queries the same information as the level 1 extension tests of
+tempest_addons directly from a DiscoveryContext, without starting a
+nosetests process or a CLI client per service. """
+
+from tempest_report import discover
+from tempest_report import fingerprint
+
+
+def extension_aliases(context, service_type, interface='publicURL'):
+    """ Return the extension aliases of a service """
+    path = fingerprint.EXTENSION_PATHS.get(service_type, 'extensions')
+    return fingerprint.aliases(context.get(service_type, path, interface))
+
+
+def keystone_extensions(context):
+    """ Return the extension aliases of the public and admin API """
+    aliases = extension_aliases(context, 'identity')
+    try:
+        aliases.extend(extension_aliases(context, 'identity', 'adminURL'))
+    except Exception:
+        # The admin API is often not reachable for users
+        pass
+    return aliases
+
+
+def ceilometer_meters(context):
+    """ Return the names of all meters """
+    return [meter['name'] for meter in context.get('metering', 'v2/meters')]
+
+
+# Test replaced by a probe: (function, extra args, prefix of the subtests)
+PROBES = {
+    'tempest_report.tempest_addons:NovaExtensionTest':
+    (extension_aliases, ('compute', ), 'nova-extension'),
+    'tempest_report.tempest_addons:CinderExtensionTest':
+    (extension_aliases, ('volume', ), 'cinder-extension'),
+    'tempest_report.tempest_addons:NeutronExtensionTest':
+    (extension_aliases, ('network', ), 'neutron-extension'),
+    'tempest_report.tempest_addons:KeystoneExtensionTest':
+    (keystone_extensions, (), 'keystone-extension'),
+    'tempest_report.tempest_addons:CeilometerTest':
+    (ceilometer_meters, (), 'ceilometer-meter'),
+}
+
+
+def fast_discovery(context, testnames):
+    """ Run the probes replacing the given tests concurrently.
+
+    Returns a dict mapping every replaced test to its output, in the same
+    "<subtest> ... ok" format printed by the tests. Tests without a probe
+    or whose probe failed are not part of the result and need to be run. """
+    probes = {}
+    for testname in testnames:
+        if testname in PROBES:
+            function, args, _prefix = PROBES[testname]
+            probes[testname] = (function, (context, ) + args, None)
+    if not probes:
+        return {}
+
+    outputs = {}
+    for testname, names in discover.run_probes(probes).items():
+        if names is None:
+            continue
+        prefix = PROBES[testname][2]
+        outputs[testname] = ''.join("%s-%s ... ok\n" % (prefix, name)
+                                    for name in sorted(set(names)))
+    return outputs
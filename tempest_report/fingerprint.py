@@ -0,0 +1,141 @@
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Fingerprints of the services of a cloud, used to only revalidate tests
+of services that changed since the last run. """
+
+import hashlib
+import json
+import urlparse
+
+import requests
+
+from tempest_report import settings
+from tempest_report import storage
+from tempest_report import trie
+
+
+# Path of the extension list relative to the catalog endpoint
+EXTENSION_PATHS = {
+    'network': 'v2.0/extensions',
+}
+
+# Catalog types by test id prefix
+SERVICE_TYPES = trie.PrefixTrie(settings.service_types)
+
+
+def service_type(testname):
+    """ Return the catalog type of the service a test belongs to """
+    return SERVICE_TYPES.longest_prefix(testname)
+
+
+def aliases(body):
+    """ Return the aliases of an extension list response """
+    extensions = body.get('extensions', [])
+    if isinstance(extensions, dict):
+        # Keystone wraps the list into {'values': [...]}
+        extensions = extensions.get('values', [])
+    return [ext.get('alias') for ext in extensions]
+
+
+def _get_json(session, url, token):
+    response = session.get(url, headers={'X-Auth-Token': token,
+                                         'Accept': 'application/json'},
+                           timeout=30)
+    try:
+        return response.status_code, response.json()
+    except ValueError:
+        return response.status_code, None
+
+
+def probe_service(session, token, stype, endpoint):
+    """ Return the version document and the extension aliases of a service """
+    parsed = urlparse.urlparse(endpoint)
+    root = "%s://%s/" % (parsed.scheme, parsed.netloc)
+    version = _get_json(session, root, token)
+
+    url = "%s/%s" % (endpoint.rstrip('/'),
+                     EXTENSION_PATHS.get(stype, 'extensions'))
+    status, body = _get_json(session, url, token)
+    extensions = None
+    if body:
+        extensions = sorted(aliases(body))
+    return {'version': version, 'extensions': (status, extensions)}
+
+
+def service_fingerprints(services, token, session=None):
+    """ Return a fingerprint for every service of the catalog.
+
+    services maps the catalog type to its endpoint. The fingerprint of a
+    service that couldn't be probed is None and never matches. """
+    session = session or requests.Session()
+    fingerprints = {}
+    for stype, endpoint in services.items():
+        try:
+            probe = probe_service(session, token, stype, endpoint)
+        except requests.RequestException:
+            fingerprints[stype] = None
+            continue
+        probe['endpoint'] = endpoint
+        fingerprints[stype] = hashlib.sha1(
+            json.dumps(probe, sort_keys=True)).hexdigest()
+    return fingerprints
+
+
+def cloud_fingerprints(context):
+    """ Return the fingerprints of all services of a discover.DiscoveryContext
+    """
+    return service_fingerprints(context.services, context.token,
+                                context.session)
+
+
+class ResultCache(object):
+    """ Passed tests of the last run of a cloud, together with the
+    fingerprints of its services at that time. Failed tests aren't stored
+    and always run again. """
+
+    def __init__(self, path, fingerprints):
+        self.path = path
+        self.fingerprints = fingerprints
+        data = storage.load_json(path, {})
+        self.previous_fingerprints = data.get('fingerprints', {})
+        # Files of former versions also stored failed tests
+        self.previous_tests = dict(
+            (testname, result)
+            for testname, result in data.get('tests', {}).items()
+            if result.get('success', True))
+        self.tests = {}
+
+    def unchanged(self, testname):
+        """ Return True if the stored result of a test can be reused """
+        stype = service_type(testname)
+        fingerprint = self.fingerprints.get(stype)
+        return (testname in self.previous_tests and
+                fingerprint is not None and
+                fingerprint == self.previous_fingerprints.get(stype))
+
+    def get(self, testname):
+        """ Return the stored (success, output, subtests) of a test """
+        result = self.previous_tests[testname]
+        self.tests[testname] = result
+        return (True, '', result['subtests'])
+
+    def add(self, testname, success, output, subtests):
+        # The output of passed tests isn't reported
+        if success:
+            self.tests[testname] = {'subtests': subtests}
+
+    def save(self):
+        storage.save_json(self.path, {'fingerprints': self.fingerprints,
+                                      'tests': self.tests})
@@ -0,0 +1,232 @@
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Aggregation of the NDJSON reports of many clouds and runs.
+
+Every run is reduced to a bitset, a Python int with one bit per test of
+settings.description_list it passed. The services, releases and features of
+a run are found with a few bitwise operations on masks built once from
+description_list, instead of summarizing the passed tests of every run
+again. Tests not in description_list are ignored.
+"""
+
+import collections
+import json
+import optparse
+import os
+import sys
+
+from tempest_report import settings
+from tempest_report import trie
+
+
+class FeatureIndex(object):
+    """ Bit masks of the tests of description_list by service, release and
+    feature """
+
+    def __init__(self, description_list=None, service_names=None):
+        if description_list is None:
+            description_list = settings.description_list
+        if service_names is None:
+            service_names = settings.service_names
+
+        services = trie.PrefixTrie(service_names)
+        self.bits = {}
+        self.service_masks = collections.defaultdict(int)
+        self.feature_masks = collections.defaultdict(int)
+        release_masks = collections.defaultdict(
+            lambda: collections.defaultdict(int))
+
+        for bit, test in enumerate(sorted(description_list)):
+            self.bits[test] = bit
+            service = services.longest_prefix(test)
+            if not service:
+                continue
+            mask = 1 << bit
+            self.service_masks[service] |= mask
+            values = description_list[test]
+            if values.get('release'):
+                release_masks[service][values['release']] |= mask
+            if values.get('feature'):
+                self.feature_masks[(service, values['feature'])] |= mask
+
+        # Highest release first, the first match is the release of a run
+        self.release_masks = dict(
+            (service, sorted(masks.items(), reverse=True))
+            for service, masks in release_masks.items())
+
+    def bitset(self, passed_tests):
+        """ Return the bitset of the known tests of passed_tests """
+        bits = 0
+        for test in passed_tests:
+            bit = self.bits.get(test)
+            if bit is not None:
+                bits |= 1 << bit
+        return bits
+
+    def services(self, bits):
+        return sorted(service for service, mask in self.service_masks.items()
+                      if bits & mask)
+
+    def release(self, bits, service):
+        """ Return the highest release of the passed tests of a service """
+        for release, mask in self.release_masks.get(service, []):
+            if bits & mask:
+                return release
+        return 0
+
+    def features(self, bits):
+        """ Return the (service, feature) tuples of the passed tests """
+        return sorted(key for key, mask in self.feature_masks.items()
+                      if bits & mask)
+
+    def feature_mask(self, feature, service=None):
+        """ Return the mask of a feature, of all services with a feature of
+        this name unless service is given. Raises KeyError if unknown. """
+        mask = 0
+        for (feature_service, name), feature_mask in \
+                self.feature_masks.items():
+            if name == feature and service in (None, feature_service):
+                mask |= feature_mask
+        if not mask:
+            raise KeyError(feature)
+        return mask
+
+
+class Run(object):
+    """ Bitset of the passed tests of a run of a cloud """
+    __slots__ = ('cloud', 'started', 'bits')
+
+    def __init__(self, cloud, started, bits):
+        self.cloud = cloud
+        self.started = started
+        self.bits = bits
+
+
+class Fleet(object):
+    """ Runs of many clouds, questions are answered for the latest run of
+    every cloud """
+
+    def __init__(self, index=None):
+        self.index = index or FeatureIndex()
+        self.runs = []
+
+    def add_run(self, cloud, started, passed_tests):
+        self.runs.append(Run(cloud, started, self.index.bitset(passed_tests)))
+
+    def load_report(self, path):
+        """ Add the run of a NDJSON report. Reports of interrupted runs are
+        used up to their last complete line, reports without a run record
+        are named after their file. """
+        cloud = started = None
+        passed = set()
+        with open(path) as report:
+            for line in report:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                kind = record.get('type')
+                if kind == 'run':
+                    cloud = record.get('cloud')
+                    started = record.get('started')
+                elif kind == 'test' and record.get('status') == 'success':
+                    passed.add(record['id'])
+                elif kind == 'summary':
+                    passed.update(record.get('passed', []))
+        if not cloud:
+            cloud = os.path.splitext(os.path.basename(path))[0]
+        self.add_run(cloud, started, passed)
+
+    def latest(self):
+        """ Return the bitset of the latest run of every cloud """
+        latest = {}
+        for run in sorted(self.runs, key=lambda run: run.started or ''):
+            latest[run.cloud] = run.bits
+        return latest
+
+    def missing(self, feature, service=None):
+        """ Return the clouds lacking a feature """
+        mask = self.index.feature_mask(feature, service)
+        return sorted(cloud for cloud, bits in self.latest().items()
+                      if not bits & mask)
+
+    def coverage(self):
+        """ Return the number of clouds with every (service, feature) """
+        latest = self.latest().values()
+        return dict((key, sum(1 for bits in latest if bits & mask))
+                    for key, mask in self.index.feature_masks.items())
+
+    def releases(self):
+        """ Return the number of clouds per service and release """
+        releases = collections.defaultdict(collections.Counter)
+        for bits in self.latest().values():
+            for service in self.index.services(bits):
+                releases[service][self.index.release(bits, service)] += 1
+        return releases
+
+
+def summary(fleet):
+    """ Return the release distribution and feature coverage as text """
+    clouds = len(fleet.latest())
+    lines = ["%d clouds, %d runs" % (clouds, len(fleet.runs))]
+    coverage = fleet.coverage()
+    for service, releases in sorted(fleet.releases().items()):
+        lines.append("\n%s:" % service)
+        for release, count in sorted(releases.items(), reverse=True):
+            lines.append("\t%-24s %d" % (
+                settings.name_mapping.get(release, 'unknown'), count))
+        for (feature_service, feature), count in sorted(coverage.items()):
+            if feature_service == service:
+                lines.append("\t\t\t\t%-32s %d/%d" % (feature, count, clouds))
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = optparse.OptionParser(usage='''
+usage: %%prog [--missing <feature>] [--service <service>]
+             <report.ndjson> [<report.ndjson> ...]
+
+Aggregates the NDJSON reports of tempest-report (--ndjson) of many clouds and
+runs. Prints the number of clouds per service and release, and the number of
+clouds with every feature, using the latest run of every cloud.
+
+Examples:
+  %%prog reports/*.ndjson
+  %%prog --missing "Container Quota" reports/*.ndjson
+'''.strip('\n') % globals())
+    parser.add_option('--missing', dest="missing", metavar='<feature>',
+                      help='List the clouds lacking this feature.')
+    parser.add_option('--service', dest="service", metavar='<service>',
+                      help='Only consider the feature of this service, '
+                           'like "Compute (Nova)".')
+    (options, args) = parser.parse_args()
+
+    if not args:
+        parser.print_usage()
+        sys.exit(1)
+
+    fleet = Fleet()
+    for path in args:
+        fleet.load_report(path)
+
+    if options.missing:
+        try:
+            clouds = fleet.missing(options.missing, options.service)
+        except KeyError:
+            parser.error("Unknown feature: %s" % options.missing)
+        for cloud in clouds:
+            print cloud
+    else:
+        sys.stdout.write(summary(fleet))
@@ -0,0 +1,74 @@
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Durations of previous runs, used to schedule the longest tests first """
+
+import threading
+
+from tempest_report import scheduler
+from tempest_report import storage
+
+
+# Expected durations in seconds of tests without any history
+DEFAULT_DURATIONS = {
+    'light': 10.0,
+    'heavy': 300.0,
+}
+
+
+class DurationHistory(object):
+    """ Test durations of a single cloud, stored in a JSON file shared by
+    all clouds. Durations are smoothed over the runs. """
+
+    smoothing = 0.5
+
+    def __init__(self, path, cloud):
+        self.path = path
+        self.cloud = cloud
+        self.lock = threading.Lock()
+        data = storage.load_json(path, {})
+        self.durations = data.get(cloud, {})
+
+        self.defaults = dict(DEFAULT_DURATIONS)
+        known = {}
+        for testname, duration in self.durations.items():
+            rclass = scheduler.resource_class(testname)
+            known.setdefault(rclass, []).append(duration)
+        for rclass, durations in known.items():
+            self.defaults[rclass] = sum(durations) / len(durations)
+
+    def expected(self, testname):
+        """ Return the expected duration of a test or a tuple of tests """
+        if isinstance(testname, tuple):
+            return sum(self.expected(test) for test in testname)
+        duration = self.durations.get(testname)
+        if duration is None:
+            rclass = scheduler.resource_class(testname)
+            duration = self.defaults.get(rclass, DEFAULT_DURATIONS['light'])
+        return duration
+
+    def record(self, testname, duration):
+        with self.lock:
+            previous = self.durations.get(testname)
+            if previous is not None:
+                duration = (self.smoothing * duration +
+                            (1 - self.smoothing) * previous)
+            self.durations[testname] = duration
+
+    def save(self):
+        """ Merge the durations of this cloud into the history file """
+        with self.lock:
+            data = storage.load_json(self.path, {})
+            data[self.cloud] = self.durations
+            storage.save_json(self.path, data)
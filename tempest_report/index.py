@@ -0,0 +1,212 @@
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Static index of the tempest tests.
+
+The sources are parsed with ast instead of importing them, and the index is
+cached per tempest version. Only files modified since the cached index was
+built are parsed again. """
+
+import ast
+import os
+
+import pkg_resources
+
+from tempest_report import storage
+
+
+# Version of the cached index entries, older caches are parsed again
+INDEX_FORMAT = 2
+
+
+def package_version(name='tempest'):
+    try:
+        return pkg_resources.get_distribution(name).version
+    except pkg_resources.DistributionNotFound:
+        return ''
+
+
+def dotted_name(node):
+    """ Return the dotted name of a Name or Attribute node, or None """
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        value = dotted_name(node.value)
+        if value:
+            return '%s.%s' % (value, node.attr)
+    return None
+
+
+def parse_module(path):
+    """ Return the index entry of a module:
+
+    classes maps the test classes to the names of the test methods defined
+    in their body, inherited tests are not listed. bases maps the classes
+    to their base classes, as the full dotted name of imported classes, the
+    name of classes of the same module or None if unknown. functions lists
+    the module-level test functions. """
+    try:
+        with open(path) as source:
+            tree = ast.parse(source.read(), path)
+    except (IOError, SyntaxError, TypeError):
+        return {}
+
+    imported = {}
+    classes = {}
+    bases = {}
+    functions = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.asname:
+                    imported[alias.asname] = alias.name
+                else:
+                    name = alias.name.split('.')[0]
+                    imported[name] = name
+        elif isinstance(node, ast.ImportFrom) and not node.level:
+            for alias in node.names:
+                imported[alias.asname or alias.name] = '%s.%s' % (
+                    node.module, alias.name)
+        elif (isinstance(node, ast.FunctionDef) and
+                node.name.startswith('test')):
+            functions.append(node.name)
+        elif isinstance(node, ast.ClassDef):
+            classes[node.name] = [item.name for item in node.body
+                                  if isinstance(item, ast.FunctionDef) and
+                                  item.name.startswith('test')]
+            bases[node.name] = []
+            for base in node.bases:
+                name = dotted_name(base)
+                if name:
+                    first, dot, rest = name.partition('.')
+                    if first in imported and first not in classes:
+                        name = imported[first] + dot + rest
+                bases[node.name].append(name)
+    return {'classes': classes, 'bases': bases, 'functions': functions}
+
+
+def module_files(package_dir, prefix):
+    """ Yield (module name, path) of all modules of a package, like
+    pkgutil.walk_packages but without importing anything """
+    for dirpath, dirnames, filenames in os.walk(package_dir):
+        if not os.path.exists(os.path.join(dirpath, '__init__.py')):
+            dirnames[:] = []
+            continue
+        dirnames.sort()
+        relpath = os.path.relpath(dirpath, package_dir)
+        package = prefix.rstrip('.')
+        if relpath != '.':
+            package += '.' + relpath.replace(os.sep, '.')
+        if dirpath != package_dir:
+            yield package, os.path.join(dirpath, '__init__.py')
+        for filename in sorted(filenames):
+            name, ext = os.path.splitext(filename)
+            if ext == '.py' and name != '__init__':
+                yield '%s.%s' % (package, name), os.path.join(dirpath,
+                                                              filename)
+
+
+class TestIndex(object):
+    """ Modules, test classes and test methods of a package """
+
+    def __init__(self, modules):
+        # Module name -> entry of parse_module() and its 'mtime'
+        self.modules = modules
+        self.packages = set(name.split('.')[0] for name in modules)
+
+    def module_names(self):
+        return sorted(self.modules)
+
+    def classes(self, module):
+        return self.modules.get(module, {}).get('classes', {})
+
+    def methods(self, module):
+        """ Return the ids (module:Class.method) of the tests of a module """
+        return ['%s:%s.%s' % (module, cls, method)
+                for cls, methods in sorted(self.classes(module).items())
+                for method in methods]
+
+    def functions(self, module):
+        """ Return the module-level test functions of a module """
+        return self.modules.get(module, {}).get('functions', [])
+
+    def _has_tests(self, module, cls, seen):
+        """ Return True if a class defines or inherits test methods, or
+        might do so as one of its bases is unknown """
+        if (module, cls) in seen:
+            return False
+        seen.add((module, cls))
+        classes = self.classes(module)
+        if cls not in classes:
+            return module.split('.')[0] in self.packages
+        if classes[cls]:
+            return True
+        return self._inherits_tests(module, cls, seen)
+
+    def _inherits_tests(self, module, cls, seen):
+        bases = self.modules.get(module, {}).get('bases', {})
+        for base in bases.get(cls, []):
+            if base is None:
+                return True
+            if '.' not in base:
+                if base in self.classes(module):
+                    if self._has_tests(module, base, seen):
+                        return True
+                elif base != 'object':
+                    return True
+                continue
+            base_module, base_cls = base.rsplit('.', 1)
+            if self._has_tests(base_module, base_cls, seen):
+                return True
+        return False
+
+    def inherits_tests(self, module):
+        """ Return True if a class of a module inherits test methods, which
+        aren't listed by methods() """
+        return any(self._inherits_tests(module, cls, set())
+                   for cls in self.classes(module))
+
+
+def load_index(package_dir, prefix='tempest.', cache_path=None,
+               version=None):
+    """ Return the TestIndex of a package, reusing the cached entries of all
+    files not modified since they were indexed """
+    if version is None:
+        version = package_version(prefix.rstrip('.'))
+
+    cached = {}
+    if cache_path:
+        data = storage.load_json(cache_path, {})
+        if (data.get('version') == version and
+                data.get('package_dir') == package_dir and
+                data.get('format') == INDEX_FORMAT):
+            cached = data.get('modules', {})
+
+    modules = {}
+    for name, path in module_files(package_dir, prefix):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
+        entry = cached.get(name)
+        if entry is None or entry.get('mtime') != mtime:
+            entry = dict(parse_module(path), mtime=mtime)
+        modules[name] = entry
+
+    if cache_path and modules != cached:
+        storage.save_json(cache_path, {'version': version,
+                                       'package_dir': package_dir,
+                                       'format': INDEX_FORMAT,
+                                       'modules': modules})
+    return TestIndex(modules)
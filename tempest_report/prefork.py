@@ -0,0 +1,183 @@
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Prefork execution engine.
+
+A server process imports tempest once and forks a copy-on-write child for
+every test, which saves the interpreter start-up and import time of a new
+nosetests process per test. Every child runs in its own process group, which
+is killed when the test exceeds its timeout.
+"""
+
+import cPickle as pickle
+import os
+import shutil
+import signal
+import socket
+import SocketServer
+import StringIO
+import sys
+import tempfile
+import traceback
+
+
+PRELOAD_MODULES = ['nose', 'tempest', 'tempest_report.tempest_addons']
+
+
+def run_test(testname):
+    """ Run a single test with the nose loader and return (success, output) """
+    import nose.config
+    import nose.core
+    import nose.loader
+
+    output = StringIO.StringIO()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = output
+    try:
+        config = nose.config.Config(stream=output, verbosity=2)
+        loader = nose.loader.TestLoader(config=config)
+        runner = nose.core.TextTestRunner(stream=output, verbosity=2,
+                                          config=config)
+        result = runner.run(loader.loadTestsFromNames([testname]))
+        success = result.wasSuccessful()
+    except Exception:
+        output.write(traceback.format_exc())
+        success = False
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    return (success, output.getvalue())
+
+
+class TestRequestHandler(SocketServer.StreamRequestHandler):
+    """ Executes the requested test in the forked child, after sending the
+    pid of the child to the client """
+
+    def handle(self):
+        os.setpgrp()
+        self.wfile.write("%d\n" % os.getpid())
+        self.wfile.flush()
+        testname = self.rfile.readline().strip()
+        pickle.dump(run_test(testname), self.wfile, pickle.HIGHEST_PROTOCOL)
+
+
+class ForkingUnixServer(SocketServer.ForkingMixIn,
+                        SocketServer.UnixStreamServer):
+    request_queue_size = 128
+
+
+class PreforkServer(object):
+    """ Server process with tempest imported for a single config file """
+
+    def __init__(self, configfile, preload=None):
+        self.configfile = configfile
+        self.preload = preload or PRELOAD_MODULES
+        self.socket_dir = None
+        self.pid = None
+
+    @property
+    def address(self):
+        return os.path.join(self.socket_dir, 'prefork.sock')
+
+    def start(self):
+        """ Fork the server process. The socket is bound before forking so
+        requests never race with the server start-up.
+
+        The server is forked after the discovery threads ran, and threads of
+        this process don't exist in the server. A lock one of them held
+        while forking stays locked in the server and might block its tests,
+        which is bounded by the timeout of execute(). """
+        self.socket_dir = tempfile.mkdtemp(prefix='tempest_report_prefork_')
+        server = ForkingUnixServer(self.address, TestRequestHandler)
+
+        pid = os.fork()
+        if pid:
+            server.socket.close()
+            self.pid = pid
+            return
+
+        try:
+            os.environ['TEMPEST_CONFIG_DIR'] = os.path.dirname(
+                self.configfile)
+            os.environ['TEMPEST_CONFIG'] = os.path.basename(self.configfile)
+            for module in self.preload:
+                try:
+                    __import__(module)
+                except Exception:
+                    # The error is reported by the loader for every test
+                    pass
+            server.serve_forever()
+        finally:
+            os._exit(1)
+
+    def execute(self, testname, timeout=None):
+        """ Run a test in a forked child and return (success, output). The
+        child is killed if the test takes longer than timeout seconds. """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        pid = None
+        try:
+            sock.connect(self.address)
+            sock.sendall(testname + '\n')
+            response = sock.makefile('rb')
+            pid = int(response.readline())
+            return pickle.load(response)
+        except socket.timeout:
+            if pid:
+                # The server reaps its killed children
+                try:
+                    os.killpg(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            return (False, "Test timed out after %gs, killed" % timeout)
+        except (socket.error, EOFError, ValueError,
+                pickle.UnpicklingError), error:
+            return (False, "Prefork server failed to run %s: %s" %
+                    (testname, error))
+        finally:
+            sock.close()
+
+    def stop(self):
+        if self.pid:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+                os.waitpid(self.pid, 0)
+            except OSError:
+                pass
+            self.pid = None
+        if self.socket_dir:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+            self.socket_dir = None
+
+
+class PreforkExecuter(object):
+    """ Drop-in replacement for utils.executer using one prefork server per
+    config file. Tests running longer than timeout seconds are killed. """
+
+    def __init__(self, preload=None, timeout=None):
+        self.preload = preload
+        self.timeout = timeout
+        self.servers = {}
+
+    def start(self, configfile):
+        server = PreforkServer(configfile, self.preload)
+        server.start()
+        self.servers[configfile] = server
+
+    def stop(self):
+        for server in self.servers.values():
+            server.stop()
+        self.servers = {}
+
+    def __call__(self, testname, configfile):
+        return self.servers[configfile].execute(testname, self.timeout)
@@ -0,0 +1,205 @@
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Reports written while the tests are running """
+
+import datetime
+import json
+import threading
+from xml.sax import saxutils
+
+try:
+    from subunit import iso8601
+    import subunit.v2
+except ImportError:
+    subunit = None
+
+from tempest_report import scheduler
+from tempest_report import settings
+from tempest_report import spool
+
+
+class Reporter(object):
+    """ Base class of the reports. Every report defines add(), which is
+    called with the TestRecord of every finished test. add_summary() is
+    called once with the service summary and all passed tests and subtests
+    at the end of the run. """
+
+    def add_summary(self, services, passed_tests):
+        pass
+
+    def close(self):
+        pass
+
+
+class JUnitWriter(Reporter):
+    """ Writes a junit file one testcase at a time.
+
+    The file is a complete report after every test: the closing tag is
+    rewritten after each testcase, and the counters of the testsuite are
+    updated in place. Whitespace before the end of the testsuite tag
+    reserves the space for the counters. """
+
+    COUNTERS_WIDTH = 80
+
+    def __init__(self, path, title):
+        self.path = path
+        self.title = title
+        self.tests = 0
+        self.failures = 0
+        self.time = 0.0
+        self.lock = threading.Lock()
+
+        self.fileobj = open(path, 'w')
+        self._write_header()
+        self.body_end = self.fileobj.tell()
+        self._write_footer()
+
+    def _write_header(self):
+        counters = 'tests="%d" failures="%d" time="%.3f"' % (
+            self.tests, self.failures, self.time)
+        self.fileobj.seek(0)
+        self.fileobj.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                           '<testsuite name=%s %s>\n' % (
+                               saxutils.quoteattr(self.title),
+                               counters.ljust(self.COUNTERS_WIDTH)))
+
+    def _write_footer(self):
+        self.fileobj.seek(self.body_end)
+        self.fileobj.write('</testsuite>\n')
+        self.fileobj.truncate()
+        self.fileobj.flush()
+
+    def _write_properties(self, usage):
+        self.fileobj.write('        <properties>\n')
+        for name, value in sorted(usage.as_dict().items()):
+            if value is not None:
+                self.fileobj.write('            <property name="%s" '
+                                   'value="%s"/>\n' % (name, value))
+        self.fileobj.write('        </properties>\n')
+
+    def add(self, record):
+        """ Append the testcase of a TestRecord """
+        name = saxutils.quoteattr(spool.utf8(record.testname))
+        duration = record.duration or 0.0
+        with self.lock:
+            self.tests += 1
+            self.failures += 0 if record.success else 1
+            self.time += duration
+            self.fileobj.seek(self.body_end)
+            if record.success and record.usage is None:
+                self.fileobj.write('    <testcase name=%s time="%.3f"/>\n' %
+                                   (name, duration))
+            else:
+                self.fileobj.write('    <testcase name=%s time="%.3f">\n' %
+                                   (name, duration))
+                if record.usage is not None:
+                    self._write_properties(record.usage)
+                if not record.success:
+                    self.fileobj.write('        <failure>\n')
+                    # Spooled outputs are read chunk by chunk
+                    for chunk in spool.chunks(record.output):
+                        self.fileobj.write(saxutils.escape(spool.utf8(chunk)))
+                    self.fileobj.write('        </failure>\n')
+                self.fileobj.write('    </testcase>\n')
+            self.body_end = self.fileobj.tell()
+            self._write_header()
+            self._write_footer()
+
+    def close(self):
+        with self.lock:
+            self.fileobj.close()
+
+
+class SubunitWriter(Reporter):
+    """ Writes a subunit v2 stream one test at a time. Requires the optional
+    python-subunit package. """
+
+    def __init__(self, path):
+        if subunit is None:
+            raise ImportError("Writing subunit streams requires "
+                              "python-subunit")
+        self.path = path
+        self.lock = threading.Lock()
+        self.fileobj = open(path, 'wb')
+        self.stream = subunit.v2.StreamResultToBytes(self.fileobj)
+
+    def add(self, record):
+        """ Write the start, output and status of a TestRecord """
+        end = datetime.datetime.now(iso8601.UTC)
+        start = end - datetime.timedelta(seconds=record.duration or 0)
+        with self.lock:
+            self.stream.status(test_id=record.testname,
+                               test_status='inprogress', timestamp=start)
+            for chunk in spool.chunks(record.output):
+                self.stream.status(test_id=record.testname,
+                                   file_name='stdout',
+                                   file_bytes=spool.utf8(chunk),
+                                   mime_type='text/plain; charset=utf8',
+                                   timestamp=end)
+            self.stream.status(test_id=record.testname, file_name='stdout',
+                               file_bytes='', eof=True, timestamp=end)
+            self.stream.status(test_id=record.testname,
+                               test_status='success' if record.success
+                               else 'fail', timestamp=end)
+            self.fileobj.flush()
+
+    def close(self):
+        with self.lock:
+            self.fileobj.close()
+
+
+class NDJSONWriter(Reporter):
+    """ Writes one JSON object per line: a "run" record with the name of the
+    cloud and the start of the run, a "test" record for every finished test
+    and a final "summary" record with the detected services and the passed
+    tests, which fleet aggregates across runs. """
+
+    def __init__(self, path, cloud=None, started=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fileobj = open(path, 'w')
+        self._write({'type': 'run',
+                     'cloud': cloud,
+                     'started': started.isoformat() if started else None})
+
+    def _write(self, data):
+        with self.lock:
+            self.fileobj.write(json.dumps(data, sort_keys=True) + '\n')
+            self.fileobj.flush()
+
+    def add(self, record):
+        values = settings.description_list.get(record.testname, {})
+        self._write({'type': 'test',
+                     'id': record.testname,
+                     'status': 'success' if record.success else 'fail',
+                     'duration': record.duration,
+                     'service': scheduler.service_name(record.testname),
+                     'feature': values.get('feature'),
+                     'release': values.get('release'),
+                     'usage': (record.usage.as_dict()
+                               if record.usage is not None else None)})
+
+    def add_summary(self, services, passed_tests):
+        self._write({'type': 'summary',
+                     'services': dict(
+                         (name, {'release': service.release,
+                                 'release_name': service.release_name,
+                                 'features': service.get_features()})
+                         for name, service in services.items()),
+                     'passed': sorted(passed_tests)})
+
+    def close(self):
+        with self.lock:
+            self.fileobj.close()
@@ -0,0 +1,171 @@
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Results of the tests of a cloud, shared by the worker threads """
+
+import collections
+import threading
+
+from tempest_report import spool
+
+
+def _intern(name):
+    """ Intern a test id, ids read from JSON state files are unicode """
+    if isinstance(name, str):
+        return intern(name)
+    return name
+
+
+class ResourceUsage(object):
+    """ Resources used by the nosetests process of a test.
+
+    Times are in seconds and max_rss in kilobytes. first_output is the time
+    until the process wrote its first line, mostly the start-up and import
+    time of nose and tempest. """
+    __slots__ = ('wall', 'user', 'sys', 'max_rss', 'first_output')
+
+    def __init__(self, wall=0.0, user=0.0, sys=0.0, max_rss=0,
+                 first_output=None):
+        self.wall = wall
+        self.user = user
+        self.sys = sys
+        self.max_rss = max_rss
+        self.first_output = first_output
+
+    @property
+    def cpu(self):
+        return self.user + self.sys
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    @classmethod
+    def total(cls, usages):
+        """ Return the usage of consecutive processes, or None if none of
+        them was measured """
+        usages = [usage for usage in usages if usage is not None]
+        if not usages:
+            return None
+        first_outputs = [usage.first_output for usage in usages
+                         if usage.first_output is not None]
+        return cls(wall=sum(usage.wall for usage in usages),
+                   user=sum(usage.user for usage in usages),
+                   sys=sum(usage.sys for usage in usages),
+                   max_rss=max(usage.max_rss for usage in usages),
+                   first_output=sum(first_outputs) if first_outputs else None)
+
+
+class TestRecord(object):
+    """ Result of a single test """
+    __slots__ = ('testname', 'success', 'output', 'duration', 'usage')
+
+    def __init__(self, testname, success, output, duration=None, usage=None):
+        self.testname = testname
+        self.success = success
+        self.output = output
+        self.duration = duration
+        self.usage = usage
+
+
+class ResultStore(object):
+    """ Thread-safe store of test results and successful subtests.
+
+    Tests and subtests are kept in the order they were added, membership
+    tests are constant time. A test added again replaces its former result.
+    Every listener is called with the TestRecord of each added test. Large
+    outputs are moved to a temporary file, see spool.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = collections.OrderedDict()
+        self.passed = set()
+        # Used as ordered set, the values are always None
+        self.subtests = collections.OrderedDict()
+        self.listeners = []
+        self.spool = spool.Spool()
+
+    def add(self, testname, success, output, duration=None, notify=True,
+            usage=None):
+        testname = _intern(testname)
+        record = TestRecord(testname, success, self.spool.store(output),
+                            duration, usage)
+        with self.lock:
+            self.records[testname] = record
+            if success:
+                self.passed.add(testname)
+            else:
+                self.passed.discard(testname)
+        if notify:
+            for listener in self.listeners:
+                listener(record)
+
+    def merge(self, testname, parts):
+        """ Replace the results of the parts of a split test with a single
+        result, which is successful if all parts passed. Returns the new
+        record, listeners are not called as they already got the parts. """
+        with self.lock:
+            records = [self.records.pop(part) for part in parts
+                       if part in self.records]
+            self.passed.difference_update(parts)
+        success = (len(records) == len(parts) and
+                   all(record.success for record in records))
+        output = self.spool.join([record.output for record in records])
+        duration = sum(record.duration or 0 for record in records)
+        usage = ResourceUsage.total(record.usage for record in records)
+        self.add(testname, success, output, duration, notify=False,
+                 usage=usage)
+        return self.records[testname]
+
+    def add_subtests(self, subtests):
+        with self.lock:
+            for subtest in subtests:
+                self.subtests[_intern(subtest)] = None
+
+    def __contains__(self, testname):
+        return testname in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        with self.lock:
+            records = self.records.values()
+        return iter(records)
+
+    def passed_test(self, testname):
+        return testname in self.passed
+
+    @property
+    def successful_tests(self):
+        return [record.testname for record in self if record.success]
+
+    @property
+    def successful_subtests(self):
+        with self.lock:
+            return self.subtests.keys()
+
+    def failed_tests(self, testnames):
+        """ Return the tests of testnames that didn't pass """
+        return [testname for testname in testnames
+                if testname not in self.passed]
+
+    def close(self):
+        """ Remove the spooled outputs """
+        self.spool.close()
+
+    def junit_tests(self):
+        """ Return (testname, output, success) tuples for gen_junit_file """
+        return [(record.testname, record.output, record.success)
+                for record in self]
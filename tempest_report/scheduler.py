@@ -0,0 +1,163 @@
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Scheduling of queued tests across the worker threads """
+
+import collections
+import heapq
+import itertools
+import Queue
+import threading
+
+from tempest_report import settings
+from tempest_report import trie
+
+
+# Service names by test id prefix
+SERVICES = trie.PrefixTrie(settings.service_names)
+
+
+def service_name(testname):
+    """ Return the service of a test, using the longest matching prefix """
+    return SERVICES.longest_prefix(testname)
+
+
+def resource_class(testname):
+    """ Return the resource class ('light' or 'heavy') of a test """
+    values = settings.description_list.get(testname)
+    if values is not None:
+        level = int(values.get('level', 1))
+        if level == 1:
+            return 'light'
+        if level == 2:
+            return 'heavy'
+    for prefix in settings.heavy_tests:
+        if testname.startswith(prefix):
+            return 'heavy'
+    return 'light'
+
+
+class Scheduler(object):
+    """ Replacement for Queue.Queue used by the workers.
+
+    Tests are handed out longest expected duration first, and in the order
+    they were put for equal durations. A test is held back while its
+    resource class or (for heavy tests) its service already runs as many
+    tests of the same config file as allowed, as the limits exist to
+    respect the quotas of a single cloud. get_nowait() only raises
+    Queue.Empty once all tests are handed out; while tests are held back it
+    waits for a running test to finish. task_done() releases the test the
+    calling thread got last, or the test got by try_get() with the same
+    token.
+    """
+
+    def __init__(self, class_limits=None, service_limits=None):
+        if class_limits is None:
+            class_limits = settings.resource_limits
+        if service_limits is None:
+            service_limits = settings.service_limits
+        self.class_limits = class_limits
+        self.service_limits = service_limits
+        self.counter = itertools.count()
+        # A heap of pending entries per (resource class, service), all
+        # entries of a heap are allowed or held back alike
+        self.pending = {}
+        self.size = 0
+        self.running = {}
+        self.class_counts = collections.defaultdict(int)
+        self.service_counts = collections.defaultdict(int)
+        self.condition = threading.Condition()
+
+    def put(self, item, duration=0):
+        """ Queue an item (testname, configfile) with its expected duration.
+        testname might also be a tuple of tests, which is classified by its
+        first test. """
+        testname, configfile = item
+        if isinstance(testname, tuple):
+            testname = testname[0]
+        rclass = (configfile, resource_class(testname))
+        service = None
+        if rclass[1] == 'heavy':
+            service = (configfile, service_name(testname))
+        with self.condition:
+            heap = self.pending.setdefault((rclass, service), [])
+            heapq.heappush(heap, (-duration, next(self.counter), item))
+            self.size += 1
+            self.condition.notify()
+
+    def qsize(self):
+        with self.condition:
+            return self.size
+
+    def _allowed(self, rclass, service):
+        limit = self.class_limits.get(rclass[1])
+        if limit and self.class_counts[rclass] >= limit:
+            return False
+        if service:
+            limit = self.service_limits.get(service[1])
+            if limit and self.service_counts[service] >= limit:
+                return False
+        return True
+
+    def _take(self, token):
+        """ Return the first allowed pending item, or None if all are held
+        back. Must be called with the condition held. """
+        first = None
+        for key, heap in self.pending.items():
+            if ((first is None or heap[0] < self.pending[first][0]) and
+                    self._allowed(*key)):
+                first = key
+        if first is None:
+            return None
+
+        heap = self.pending[first]
+        item = heapq.heappop(heap)[2]
+        if not heap:
+            del self.pending[first]
+        self.size -= 1
+        rclass, service = first
+        self.class_counts[rclass] += 1
+        if service:
+            self.service_counts[service] += 1
+        self.running[token] = first
+        return item
+
+    def get_nowait(self):
+        with self.condition:
+            while True:
+                if not self.pending:
+                    raise Queue.Empty()
+                item = self._take(threading.current_thread().ident)
+                if item is not None:
+                    return item
+                self.condition.wait()
+
+    def try_get(self, token):
+        """ Non-blocking get for a single thread running several tests.
+        Returns None while all pending tests are held back, the test is
+        released with task_done(token). """
+        with self.condition:
+            if not self.pending:
+                raise Queue.Empty()
+            return self._take(token)
+
+    def task_done(self, token=None):
+        with self.condition:
+            if token is None:
+                token = threading.current_thread().ident
+            rclass, service = self.running.pop(token)
+            self.class_counts[rclass] -= 1
+            if service:
+                self.service_counts[service] -= 1
+            self.condition.notify_all()
@@ -50,6 +50,54 @@ service_names = {
     'tempest_report.tempest_addons:Glance': 'Volume (Glance)',
 }
 
+# Service catalog types of the tests, used to revalidate only tests of
+# services that changed since the last run. Tests without a type (like the
+# scenarios, which use several services) are always executed.
+service_types = {
+    'tempest.api.object_storage': 'object-store',
+    'tempest.api.compute': 'compute',
+    'tempest.api.image': 'image',
+    'tempest.api.volume': 'volume',
+    'tempest.api.network': 'network',
+    'tempest.api.orchestration': 'orchestration',
+    'tempest.api.identity': 'identity',
+    'tempest.cli.simple_read_only.test_cinder': 'volume',
+    'tempest.cli.simple_read_only.test_glance': 'image',
+    'tempest.cli.simple_read_only.test_keystone': 'identity',
+    'tempest.cli.simple_read_only.test_neutron': 'network',
+    'tempest.cli.simple_read_only.test_nova': 'compute',
+    'tempest_report.tempest_addons:CeilometerTest': 'metering',
+    'tempest_report.tempest_addons:NeutronExtensionTest': 'network',
+    'tempest_report.tempest_addons:NovaExtensionTest': 'compute',
+    'tempest_report.tempest_addons:CinderExtensionTest': 'volume',
+    'tempest_report.tempest_addons:KeystoneExtensionTest': 'identity',
+    'tempest_report.tempest_addons:Glance': 'image',
+}
+
+# Resource classes used by the scheduler. Level 1 tests are always light,
+# level 2 tests always heavy. Other tests are heavy if they start with one
+# of these prefixes, because they boot instances or create stacks.
+heavy_tests = [
+    'tempest.scenario',
+    'tempest.api.compute',
+    'tempest.api.orchestration',
+    'tempest.api.volume',
+    'tempest.thirdparty',
+]
+
+# Maximum number of concurrently running tests per resource class, and of
+# concurrently running heavy tests per service. Missing entries or 0 mean
+# unlimited (apart from the number of workers).
+resource_limits = {
+    'heavy': 3,
+}
+
+service_limits = {
+    'Compute (Nova)': 2,
+    'Orchestration (Heat)': 1,
+    'Scenario': 2,
+}
+
 description_list = {
     # Levels:
     # 1: feature & extension discovery
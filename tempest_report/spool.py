@@ -0,0 +1,154 @@
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Storage of large test outputs in a temporary segment file.
+
+Outputs up to SPOOL_THRESHOLD bytes are kept as strings. Larger outputs are
+appended to the segment file of their Spool and replaced by a SpooledOutput,
+which only keeps an excerpt of the output in memory. Use chunks() and
+lines() to read an output regardless of where it is stored. """
+
+import os
+import tempfile
+import threading
+
+
+SPOOL_THRESHOLD = 64 * 1024
+EXCERPT_SIZE = 2 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+def utf8(value):
+    """ Return value encoded as UTF-8 if it is unicode """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class SpooledOutput(object):
+    """ Output stored in a segment file, str() returns an excerpt """
+    __slots__ = ('spool', 'offset', 'size', 'head', 'tail')
+
+    def __init__(self, spool, offset, size, head, tail):
+        self.spool = spool
+        self.offset = offset
+        self.size = size
+        self.head = head
+        self.tail = tail
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        omitted = self.size - len(self.head) - len(self.tail)
+        return "%s\n[... %d bytes omitted ...]\n%s" % (
+            self.head, omitted, self.tail)
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        return self.spool.read(self.offset, self.size, chunk_size)
+
+    def getvalue(self):
+        return ''.join(self.chunks())
+
+
+class Spool(object):
+    """ Append-only temporary segment file shared by many outputs """
+
+    def __init__(self, threshold=SPOOL_THRESHOLD, excerpt_size=EXCERPT_SIZE):
+        self.threshold = threshold
+        self.excerpt_size = excerpt_size
+        self.fileobj = None
+        # Reentrant, joining spooled outputs reads while appending
+        self.lock = threading.RLock()
+
+    def store(self, output):
+        """ Return output itself if small, or spooled to the segment file """
+        if isinstance(output, SpooledOutput) and output.spool is self:
+            return output
+        return self.join([output])
+
+    def join(self, outputs):
+        """ Return the concatenation of outputs, spooled if large """
+        size = sum(len(output) for output in outputs)
+        if size <= self.threshold:
+            if len(outputs) == 1:
+                return outputs[0]
+            return ''.join(utf8(output) for output in outputs)
+
+        with self.lock:
+            if self.fileobj is None:
+                self.fileobj = tempfile.TemporaryFile(
+                    prefix='tempest_report_output_')
+            self.fileobj.seek(0, os.SEEK_END)
+            offset = self.fileobj.tell()
+            head = tail = ''
+            for output in outputs:
+                for chunk in chunks(output):
+                    chunk = utf8(chunk)
+                    if len(head) < self.excerpt_size:
+                        head += chunk[:self.excerpt_size - len(head)]
+                    tail = (tail + chunk)[-self.excerpt_size:]
+                    self.fileobj.seek(0, os.SEEK_END)
+                    self.fileobj.write(chunk)
+            self.fileobj.seek(0, os.SEEK_END)
+            size = self.fileobj.tell() - offset
+        return SpooledOutput(self, offset, size, head, tail)
+
+    def read(self, offset, size, chunk_size=CHUNK_SIZE):
+        """ Yield the given range of the segment file in chunks """
+        end = offset + size
+        while offset < end:
+            with self.lock:
+                self.fileobj.seek(offset)
+                chunk = self.fileobj.read(min(chunk_size, end - offset))
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+
+    def close(self):
+        with self.lock:
+            if self.fileobj is not None:
+                self.fileobj.close()
+                self.fileobj = None
+
+
+def excerpt(output):
+    """ Return a string or the excerpt of a SpooledOutput """
+    if isinstance(output, SpooledOutput):
+        return str(output)
+    return output
+
+
+def chunks(output, chunk_size=CHUNK_SIZE):
+    """ Yield the content of a string or SpooledOutput in chunks """
+    if isinstance(output, SpooledOutput):
+        return output.chunks(chunk_size)
+    return iter([output] if output else [])
+
+
+def lines(output):
+    """ Yield the lines of a string or SpooledOutput, without newlines """
+    if not isinstance(output, SpooledOutput):
+        for line in output.split('\n'):
+            yield line
+        return
+
+    rest = ''
+    for chunk in output.chunks():
+        parts = (rest + chunk).split('\n')
+        rest = parts.pop()
+        for line in parts:
+            yield line
+    yield rest
@@ -0,0 +1,60 @@
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Local state kept between runs, stored as JSON files """
+
+import hashlib
+import json
+import os
+import tempfile
+
+
+STATE_DIR = os.path.expanduser('~/.tempest-report')
+
+
+def state_path(name):
+    """ Return the default path of a state file """
+    return os.path.join(STATE_DIR, name)
+
+
+def cloud_key(auth_url, tenant_name=None, region_name=None):
+    """ Return a stable key identifying a cloud """
+    ident = '|'.join([auth_url or '', tenant_name or '', region_name or ''])
+    return hashlib.sha1(ident).hexdigest()[:16]
+
+
+def load_json(path, default=None):
+    """ Load a JSON state file, returns default if missing or unreadable """
+    try:
+        with open(path) as fileobj:
+            return json.load(fileobj)
+    except (IOError, ValueError):
+        return default
+
+
+def save_json(path, data):
+    """ Atomically write a JSON state file only readable by the user """
+    dirname = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, 0700)
+
+    fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'w') as fileobj:
+            json.dump(data, fileobj)
+        os.chmod(tmpname, 0600)
+        os.rename(tmpname, path)
+    except Exception:
+        os.remove(tmpname)
+        raise
@@ -0,0 +1,276 @@
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Event loop running the tests of the subprocess engine.
+
+A single thread starts a process per test and multiplexes their outputs with
+poll(), so the number of concurrent tests isn't bound to a number of threads
+and the run ends as soon as the last test finished. Every test runs in its
+own process group, which is killed when the test exceeds its deadline, the
+deadline of the run passes or the run is cancelled with Ctrl-C.
+"""
+
+import errno
+import itertools
+import os
+import Queue
+import select
+import signal
+import StringIO
+import time
+
+from tempest_report import results
+
+
+# Seconds between SIGTERM and SIGKILL of the process group of a test
+KILL_GRACE = 5
+READ_SIZE = 64 * 1024
+# Milliseconds between checks for processes which closed their output
+REAP_INTERVAL = 10
+
+
+def wait_with_usage(process, usage, options=0):
+    """ Wait for a process and store its CPU time and peak memory in usage.
+
+    Returns the exit code like Popen.wait(), or None if options contains
+    os.WNOHANG and the process is still running. """
+    pid, status, rusage = os.wait4(process.pid, options)
+    if pid == 0:
+        return None
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    usage.user = rusage.ru_utime
+    usage.sys = rusage.ru_stime
+    usage.max_rss = rusage.ru_maxrss
+    return process.returncode
+
+
+def kill_group(process, sig):
+    try:
+        os.killpg(process.pid, sig)
+    except OSError:
+        # Already gone
+        pass
+
+
+class Job(object):
+    """ A running test """
+
+    def __init__(self, token, item, process, output, timeout=None):
+        self.token = token
+        self.item = item
+        self.process = process
+        self.fd = process.stdout.fileno()
+        self.output = output
+        self.partial = ''
+        self.start = time.time()
+        self.timeout = timeout
+        self.deadline = self.start + timeout if timeout else None
+        self.usage = results.ResourceUsage()
+        self.error = None
+        self.terminated = None
+        self.killed = False
+
+
+class Supervisor(object):
+    """ Runs the (testname, configfile) items of a scheduler.Scheduler.
+
+    start(testname, configfile) must return a subprocess.Popen whose stdout
+    is a pipe, started in a new process group. testname might also be a tuple
+    of tests run by a single process, which gets test_timeout per test. on_line(item, line) is called
+    for every line of output and on_result(item, success, output, duration,
+    usage) once the process exited. new_output returns the object collecting
+    the output of a test, with write() and getvalue(). """
+
+    def __init__(self, queue, start, slots, on_line=None, on_result=None,
+                 new_output=StringIO.StringIO, test_timeout=None,
+                 deadline=None, max_line_size=None, kill_grace=KILL_GRACE):
+        self.queue = queue
+        self.start = start
+        self.slots = slots
+        self.on_line = on_line
+        self.on_result = on_result
+        self.new_output = new_output
+        self.test_timeout = test_timeout
+        self.deadline = deadline
+        self.max_line_size = max_line_size
+        self.kill_grace = kill_grace
+
+        self.tokens = itertools.count()
+        self.poller = select.poll()
+        # Jobs by the descriptor of their output, and jobs whose output
+        # is closed but whose process wasn't reaped yet
+        self.reading = {}
+        self.exiting = []
+        # Why the run stopped early, None while it didn't
+        self.reason = None
+
+    @property
+    def jobs(self):
+        return self.reading.values() + self.exiting
+
+    def run(self):
+        """ Run the queued tests. Returns True if all tests ran, otherwise
+        reason tells why the run stopped early. """
+        try:
+            self._loop()
+        except KeyboardInterrupt:
+            self.stop("Run cancelled")
+            try:
+                self._loop()
+            except KeyboardInterrupt:
+                # Cancelled again, don't wait for the grace period
+                for job in self.jobs:
+                    kill_group(job.process, signal.SIGKILL)
+                    job.killed = True
+                self._loop()
+        return self.reason is None
+
+    def stop(self, reason):
+        """ Don't start further tests and terminate the running ones """
+        if self.reason is None:
+            self.reason = reason
+        for job in self.jobs:
+            self._terminate(job, reason)
+
+    def _loop(self):
+        while True:
+            self._check_deadlines()
+            self._start_tests()
+            if not self.reading and not self.exiting:
+                return
+            self._poll()
+            self._reap()
+
+    def _start_tests(self):
+        while self.reason is None and len(self.jobs) < self.slots:
+            token = next(self.tokens)
+            try:
+                item = self.queue.try_get(token)
+            except Queue.Empty:
+                return
+            if item is None:
+                # Held back until a running test finishes
+                return
+            self._spawn(token, item)
+
+    def _spawn(self, token, item):
+        try:
+            process = self.start(*item)
+        except OSError, error:
+            self.queue.task_done(token)
+            self._result(item, False, "Failed to start %s: %s\n" %
+                         (item[0], error), 0.0, None)
+            return
+        timeout = self.test_timeout
+        if timeout and isinstance(item[0], tuple):
+            timeout *= len(item[0])
+        job = Job(token, item, process, self.new_output(), timeout)
+        self.reading[job.fd] = job
+        self.poller.register(job.fd, select.POLLIN | select.POLLPRI)
+
+    def _terminate(self, job, error):
+        if job.terminated is None:
+            job.error = error
+            job.terminated = time.time()
+            kill_group(job.process, signal.SIGTERM)
+
+    def _check_deadlines(self):
+        now = time.time()
+        if (self.deadline is not None and self.reason is None and
+                now >= self.deadline):
+            self.stop("Deadline of the run exceeded")
+        for job in self.jobs:
+            if job.deadline is not None and now >= job.deadline:
+                self._terminate(job, "Test timed out after %gs, killed" %
+                                job.timeout)
+            if (job.terminated is not None and not job.killed and
+                    now >= job.terminated + self.kill_grace):
+                kill_group(job.process, signal.SIGKILL)
+                job.killed = True
+
+    def _timeout(self):
+        """ Return the milliseconds until the next deadline, or None """
+        if self.exiting:
+            return REAP_INTERVAL
+        deadlines = []
+        if self.deadline is not None and self.reason is None:
+            deadlines.append(self.deadline)
+        for job in self.jobs:
+            if job.terminated is None and job.deadline is not None:
+                deadlines.append(job.deadline)
+            elif job.terminated is not None and not job.killed:
+                deadlines.append(job.terminated + self.kill_grace)
+        if not deadlines:
+            return None
+        return max(0, int((min(deadlines) - time.time()) * 1000) + 1)
+
+    def _poll(self):
+        try:
+            events = self.poller.poll(self._timeout())
+        except select.error, error:
+            if error.args[0] == errno.EINTR:
+                return
+            raise
+        for fd, _event in events:
+            job = self.reading[fd]
+            data = os.read(fd, READ_SIZE)
+            if data:
+                self._read(job, data)
+            else:
+                self._close(job)
+
+    def _read(self, job, data):
+        if job.usage.first_output is None:
+            job.usage.first_output = time.time() - job.start
+        lines = (job.partial + data).split('\n')
+        job.partial = lines.pop()
+        for line in lines:
+            self._line(job, line + '\n')
+        if self.max_line_size and len(job.partial) >= self.max_line_size:
+            self._line(job, job.partial)
+            job.partial = ''
+
+    def _line(self, job, line):
+        job.output.write(line)
+        if self.on_line:
+            self.on_line(job.item, line)
+
+    def _close(self, job):
+        if job.partial:
+            self._line(job, job.partial)
+            job.partial = ''
+        self.poller.unregister(job.fd)
+        del self.reading[job.fd]
+        job.process.stdout.close()
+        self.exiting.append(job)
+
+    def _reap(self):
+        for job in self.exiting[:]:
+            returncode = wait_with_usage(job.process, job.usage, os.WNOHANG)
+            if returncode is None:
+                continue
+            self.exiting.remove(job)
+            job.usage.wall = time.time() - job.start
+            if job.error:
+                job.output.write("\n%s\n" % job.error)
+            self.queue.task_done(job.token)
+            self._result(job.item, returncode == 0 and job.error is None,
+                         job.output.getvalue(), job.usage.wall, job.usage)
+
+    def _result(self, item, success, output, duration, usage):
+        if self.on_result:
+            self.on_result(item, success, output, duration, usage)
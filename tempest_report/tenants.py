@@ -0,0 +1,261 @@
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Tenants and users created for the tests of a cloud.
+
+With an admin account every worker gets its own tenant and user, so tests of
+different workers don't compete for the quotas of a single tenant. The pairs
+are created concurrently and deleted at the end of the run, or kept in a
+state file from which later runs reuse them once they checked that the users
+can still authenticate.
+"""
+
+import errno
+import fcntl
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import random
+import socket
+import string
+
+import keystoneclient.exceptions
+
+from tempest_report import auth
+from tempest_report import storage
+
+
+# Maximum number of concurrent requests to keystone
+MAX_CONCURRENCY = 8
+
+
+def random_name(length=10):
+    return ''.join(random.choice(string.letters) for x in range(length))
+
+
+def new_tenant_and_user(keystone):
+    """ Create a tenant and a user with a keystone admin client """
+    username = random_name()
+    tenant_name = random_name()
+    password = random_name()
+    email = random_name(5) + 'dummy@dummy.org'
+
+    tenant = keystone.tenants.create(tenant_name=tenant_name,
+                                     description="Tenant for tempest",
+                                     enabled=True)
+    try:
+        user = keystone.users.create(username, password, email, tenant.id)
+    except Exception:
+        keystone.tenants.delete(tenant.id)
+        raise
+
+    return {'username': username,
+            'password': password,
+            'tenant_name': tenant_name,
+            'tenant_id': tenant.id,
+            'user_id': user.id}
+
+
+def create_tenant_and_user(username, password, auth_url, tenant_name,
+                           token_cache=None):
+    keystone = auth.get_client(username, password, auth_url, tenant_name,
+                               token_cache)
+    return new_tenant_and_user(keystone)
+
+
+def delete_tenant_and_user(username, password, auth_url, tenant_name, user,
+                           token_cache=None):
+    keystone = auth.get_client(username, password, auth_url, tenant_name,
+                               token_cache)
+    keystone.users.delete(user['user_id'])
+    keystone.tenants.delete(user['tenant_id'])
+
+
+def concurrently(function, items):
+    """ Return [function(item) for item in items], called concurrently """
+    if not items:
+        return []
+    pool = ThreadPool(min(len(items), MAX_CONCURRENCY))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.terminate()
+
+
+class TenantPool(object):
+    """ Tenant/user pairs of a cloud, created with its admin account.
+
+    The pairs are stored in path, a JSON file shared by all clouds, and
+    reused by later runs. A run leases the pairs it uses in the file, so
+    concurrent runs never share a pair. Without path the pairs are deleted
+    by release().
+    """
+
+    def __init__(self, path, key, username, password, auth_url,
+                 tenant_name=None, token_cache=None):
+        self.path = path
+        self.key = key
+        self.admin = (username, password, auth_url, tenant_name)
+        self.auth_url = auth_url
+        self.token_cache = token_cache
+        self.lease = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.users = []
+
+    def _admin_client(self):
+        username, password, auth_url, tenant_name = self.admin
+        return auth.get_client(username, password, auth_url, tenant_name,
+                               self.token_cache)
+
+    def valid(self, user):
+        """ Return True if the user can still authenticate, False if it is
+        rejected and None if it couldn't be checked. Users with a cached
+        token are checked without a request. """
+        try:
+            auth.get_client(user['username'], user['password'],
+                            self.auth_url, user['tenant_name'],
+                            self.token_cache)
+        except keystoneclient.exceptions.Unauthorized:
+            return False
+        except Exception, error:
+            logging.getLogger('tempest_report').warning(
+                "Failed to check user %s: %s" % (user['username'], error))
+            return None
+        return True
+
+    @staticmethod
+    def leased(user):
+        """ Return True if a running process leased the pair """
+        lease = user.get('lease')
+        if not lease:
+            return False
+        host, _sep, pid = lease.rpartition(':')
+        if host != socket.gethostname():
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except OSError, error:
+            return error.errno == errno.EPERM
+        except ValueError:
+            return False
+        return True
+
+    def _update(self, function):
+        """ Replace the stored pairs of the cloud by function(pairs), with
+        the pool file locked against concurrent runs """
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, 0700)
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            data = storage.load_json(self.path, {})
+            data[self.key] = function(data.get(self.key, []))
+            storage.save_json(self.path, data)
+
+    def _create(self, count):
+        """ Create count pairs. The pairs created before a failure are
+        leased to this pool before the error is raised, so release()
+        keeps or deletes them. """
+        keystone = self._admin_client()
+
+        def create(_nr):
+            try:
+                return new_tenant_and_user(keystone)
+            except Exception, error:
+                return error
+
+        created = concurrently(create, range(count))
+        users = [user for user in created if isinstance(user, dict)]
+        self.users.extend(users)
+        if self.path:
+            self._update(lambda stored: stored + [
+                dict(user, lease=self.lease) for user in users])
+        for error in created:
+            if isinstance(error, Exception):
+                raise error
+
+    def _delete(self, users):
+        """ Delete pairs in keystone, failures are only logged """
+        if not users:
+            return
+        keystone = self._admin_client()
+
+        def delete(user):
+            try:
+                keystone.users.delete(user['user_id'])
+                keystone.tenants.delete(user['tenant_id'])
+            except Exception, error:
+                logging.getLogger('tempest_report').warning(
+                    "Failed to delete user %s: %s" % (user['username'],
+                                                      error))
+
+        concurrently(delete, users)
+
+    def acquire(self, count):
+        """ Return count pairs, reusing the valid stored ones which aren't
+        leased by another run and creating the missing ones. Pairs
+        rejected by keystone are deleted, pairs which couldn't be checked
+        aren't used but stay stored. """
+        candidates = []
+        if self.path:
+            def lease(stored):
+                for user in stored:
+                    if len(candidates) < count and not self.leased(user):
+                        user['lease'] = self.lease
+                        candidates.append(user)
+                return stored
+            self._update(lease)
+
+        checked = concurrently(self.valid, candidates)
+        self.users = [user for user, valid in zip(candidates, checked)
+                      if valid]
+        invalid = [user for user, valid in zip(candidates, checked)
+                   if valid is False]
+        unchecked = [user['user_id'] for user, valid
+                     in zip(candidates, checked) if valid is None]
+
+        if invalid or unchecked:
+            dropped = [user['user_id'] for user in invalid]
+
+            def update(stored):
+                for user in stored:
+                    if user['user_id'] in unchecked:
+                        user.pop('lease', None)
+                return [user for user in stored
+                        if user['user_id'] not in dropped]
+            self._update(update)
+            self._delete(invalid)
+
+        if len(self.users) < count:
+            self._create(count - len(self.users))
+        self.users = [dict((name, value) for name, value in user.items()
+                           if name != 'lease') for user in self.users]
+        return self.users
+
+    def release(self):
+        """ Delete the pairs unless they are kept for later runs, in which
+        case their lease ends """
+        if not self.users:
+            return
+        if self.path:
+            ids = [user['user_id'] for user in self.users]
+
+            def unlease(stored):
+                for user in stored:
+                    if user['user_id'] in ids:
+                        user.pop('lease', None)
+                return stored
+            self._update(unlease)
+        else:
+            self._delete(self.users)
+        self.users = []
@@ -0,0 +1,79 @@
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Character trie for longest-prefix lookups of test ids """
+
+
+class _Node(object):
+    __slots__ = ('edges', 'value', 'has_value')
+
+    def __init__(self):
+        # First character of an edge -> (edge label, child node)
+        self.edges = {}
+        self.value = None
+        self.has_value = False
+
+
+class PrefixTrie(object):
+    """ Maps string prefixes to values. Chains of nodes with a single child
+    are merged into one edge, so a lookup only does one dict lookup and one
+    string comparison per branch along the key, independent of the number
+    of prefixes. """
+
+    def __init__(self, mapping=None):
+        self.root = _Node()
+        for prefix, value in (mapping or {}).items():
+            self[prefix] = value
+
+    def __setitem__(self, prefix, value):
+        node = self.root
+        pos = 0
+        while pos < len(prefix):
+            edge = node.edges.get(prefix[pos])
+            if edge is None:
+                leaf = _Node()
+                node.edges[prefix[pos]] = (prefix[pos:], leaf)
+                node = leaf
+                break
+
+            label, child = edge
+            common = 0
+            while (common < len(label) and pos + common < len(prefix) and
+                   label[common] == prefix[pos + common]):
+                common += 1
+            if common < len(label):
+                # Split the edge where the new prefix diverges
+                middle = _Node()
+                middle.edges[label[common]] = (label[common:], child)
+                node.edges[prefix[pos]] = (label[:common], middle)
+                child = middle
+            node = child
+            pos += common
+
+        node.value = value
+        node.has_value = True
+
+    def longest_prefix(self, key, default=None):
+        """ Return the value of the longest prefix of key """
+        value = default
+        node = self.root
+        pos = 0
+        while True:
+            if node.has_value:
+                value = node.value
+            edge = node.edges.get(key[pos:pos + 1])
+            if edge is None or not key.startswith(edge[0], pos):
+                return value
+            node = edge[1]
+            pos += len(edge[0])
@@ -15,102 +15,74 @@
 # under the License.
 
 
+import collections
+import ConfigParser
 import datetime
-import itertools
 import logging
 import os
-import pkgutil
 import Queue
-import random
 import re
-import string
 import subprocess
 import tempfile
 import threading
 import time
-from xml.sax import saxutils
+from xml.etree import ElementTree
 
-import keystoneclient
 import tempest
 
 from tempest_report.discover import customized_tempest_conf
+from tempest_report import auth
+from tempest_report import discover
+from tempest_report import exclude
+from tempest_report import extensions
+from tempest_report import fingerprint
+from tempest_report import history
+from tempest_report import index
+from tempest_report import prefork
+from tempest_report import reporters
+from tempest_report import results
+from tempest_report import scheduler
 from tempest_report import settings
+from tempest_report import spool
+from tempest_report import storage
+from tempest_report import supervisor
+from tempest_report import tenants
 
 
 def load_excluded_tests(fname):
     """ Load the excluded tests form a flat file."""
     if not fname:
-        return []
-
-    regexps = []
-    with open(fname) as excluded_tests:
-        for line in excluded_tests:
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-            regexps.append(re.compile(line))
-    return regexps
+        return exclude.ExcludeMatcher()
+    return exclude.ExcludeMatcher.from_file(fname)
 
 
-def test_is_excluded(testname, exclude_regexps):
+def test_is_excluded(testname, excluded_tests):
     """ Return True is the test is part of the exclude list."""
-    def test_not_match(regex):
-        return not regex.search(testname)
-
-    failed_at = len(list(itertools.takewhile(test_not_match,
-                                             exclude_regexps)))
-    excluded = failed_at != len(exclude_regexps)
-    return excluded
-
+    return excluded_tests.match(testname) is not None
 
-def create_tenant_and_user(username, password, auth_url, tenant_name):
-    keystone = keystoneclient.v2_0.client.Client(username=username,
-                                                 password=password,
-                                                 auth_url=auth_url,
-                                                 tenant_name=tenant_name)
 
-    username = ''.join(random.choice(string.letters) for x in range(10))
-    tenant_name = ''.join(random.choice(string.letters) for x in range(10))
-    password = ''.join(random.choice(string.letters) for x in range(10))
-    email = ''.join(random.choice(string.letters) for x in range(5)) + 'dummy@dummy.org'
+def gen_junit_file(filepath, title, tests):
+    writer = reporters.JUnitWriter(filepath, title)
+    for testname, output, status in tests:
+        writer.add(results.TestRecord(testname, status, output))
+    writer.close()
 
-    tenant = keystone.tenants.create(tenant_name=tenant_name,
-                                     description="Tenant for tempest",
-                                     enabled=True)
-    user = keystone.users.create(username, password, email, tenant.id)
 
-    return {'username': username,
-            'password': password,
-            'tenant_name': tenant_name,
-            'tenant_id': tenant.id,
-            'user_id': user.id}
+def report_path(path, cloud, multiple=False):
+    """ Return the path of a report of a cloud, which includes the name of
+    the cloud if several clouds are tested """
+    if multiple:
+        root, ext = os.path.splitext(path)
+        return "%s-%s%s" % (root, cloud.name, ext)
+    return path
 
 
-def delete_tenant_and_user(username, password, auth_url, tenant_name, user):
-    keystone = keystoneclient.v2_0.client.Client(username=username,
-                                                 password=password,
-                                                 auth_url=auth_url,
-                                                 tenant_name=tenant_name)
-    keystone.users.delete(user['user_id'])
-    keystone.tenants.delete(user['tenant_id'])
-
-
-def gen_junit_file(filepath, title, tests):
-    failures = len(filter(lambda x: not x[2], tests))
-
-    with open(filepath, "w") as f:
-        f.write('<testsuite failures="%d" name="%s"" tests="%s">\n' %
-                     (failures, title, len(tests)))
-        for testname, output, status in tests:
-            if status:
-                f.write('    <testcase name="%s"/>\n' % testname)
-            else:
-                f.write('    <testcase name="%s">\n' % testname)
-                f.write('        <failure>\n')
-                f.write(saxutils.escape(output))
-                f.write('        </failure>\n')
-                f.write('    </testcase>\n')
-        f.write('</testsuite>\n')
+def junit_report(options, cloud, now, multiple=False):
+    """ Return the path and title of the junit file of a cloud """
+    junit_title = "tempest-report (%s)" % now.strftime("%Y%m%d-%H%M%S")
+    if multiple:
+        junit_title = "%s %s" % (cloud.name, junit_title)
+    return report_path(options.junit, cloud, multiple), junit_title
 
 
 """ Methods to create a summary of the tests """
@@ -140,17 +112,21 @@ class ServiceSummary(object):
         return sorted(self.features)
 
 
+# Verbose nose output reports test methods as "test_name (module.Class)"
+NOSE_TEST_METHOD = re.compile(r'^\S+ \((\S+)\)$')
+
+
 def service_summary(successful_tests):
     services = {}
     for test in successful_tests:
-        service = [service
-                   for prefix, service in settings.service_names.items()
-                   if prefix in str(test)]
-        if service:
-            service_name = service[0]
+        test = str(test)
+        match = NOSE_TEST_METHOD.match(test)
+        service_name = scheduler.service_name(match.group(1) if match
+                                              else test)
+        if service_name:
             if service_name not in services:
                 services[service_name] = ServiceSummary(service_name)
-            result = settings.description_list.get(str(test))
+            result = settings.description_list.get(test)
             if result:
                 release = result.get('release', 0)
                 feature = result.get('feature')
@@ -162,135 +138,485 @@ def service_summary(successful_tests):
 """  Methods to execute the tests """
 
 
-def executer(testname, configfile):
-    """ Execute a single test """
-
-    _environ = dict(os.environ)
+# Maximum size in bytes of the output kept in memory per test
+MAX_OUTPUT_SIZE = 1024 * 1024
+
+# Maximum length of a single line read from a test
+MAX_LINE_SIZE = 64 * 1024
+
+
+class BoundedOutput(object):
+    """ Keeps the beginning and the end of a test output in memory, the
+    middle is dropped once the output exceeds max_size bytes. """
+
+    def __init__(self, max_size=MAX_OUTPUT_SIZE):
+        self.max_size = max_size
+        self.head = []
+        self.head_size = 0
+        self.tail = collections.deque()
+        self.tail_size = 0
+        self.dropped = 0
+        # Once a write went to the tail, the head is complete
+        self.head_full = False
+
+    def write(self, data):
+        if (not self.head_full and
+                self.head_size + len(data) <= self.max_size / 2):
+            self.head.append(data)
+            self.head_size += len(data)
+            return
+
+        self.head_full = True
+        self.tail.append(data)
+        self.tail_size += len(data)
+        while self.tail_size > self.max_size / 2 and len(self.tail) > 1:
+            dropped = self.tail.popleft()
+            self.tail_size -= len(dropped)
+            self.dropped += len(dropped)
+
+    def getvalue(self):
+        omitted = ''
+        if self.dropped:
+            omitted = "\n[... %d bytes omitted ...]\n" % self.dropped
+        return ''.join(self.head) + omitted + ''.join(self.tail)
+
+
+def test_environment(configfile):
+    """ Return the environment of a test process using the given config """
+    environ = dict(os.environ)
+    environ['TEMPEST_CONFIG_DIR'] = os.path.dirname(configfile)
+    environ['TEMPEST_CONFIG'] = os.path.basename(configfile)
+    environ['PYTHONUNBUFFERED'] = '1'
+    return environ
+
+
+def executer(testname, configfile, on_line=None, usage=None):
+    """ Execute a single test
+
+    The output is read while the test is running, on_line is called for
+    every line if given. Only the beginning and the end of large outputs are
+    returned. The resources used by the test are stored in usage if a
+    results.ResourceUsage is given. """
+
+    start = time.time()
+    process = subprocess.Popen(
+        ["nosetests", "-v", "-s", testname],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        env=test_environment(configfile))
+
+    output = BoundedOutput()
+    for line in iter(lambda: process.stdout.readline(MAX_LINE_SIZE), ''):
+        if usage is not None and usage.first_output is None:
+            usage.first_output = time.time() - start
+        output.write(line)
+        if on_line:
+            on_line(line)
+    process.stdout.close()
+    if usage is not None:
+        success = supervisor.wait_with_usage(process, usage) == 0
+        usage.wall = time.time() - start
+    else:
+        success = process.wait() == 0
 
-    os.environ['TEMPEST_CONFIG_DIR'] = os.path.dirname(configfile)
-    os.environ['TEMPEST_CONFIG'] = os.path.basename(configfile)
+    return (success, output.getvalue())
 
-    success = False
-    output = None
 
+def start_test(testname, configfile, xunit_file=None):
+    """ Start the nosetests process of a test for the supervisor, in a new
+    process group. A tuple of tests is run as a batch, which writes its xunit
+    report to xunit_file. """
+    if isinstance(testname, tuple):
+        command = ["nosetests", "-v", "--with-xunit",
+                   "--xunit-file=%s" % xunit_file] + list(testname)
+    else:
+        command = ["nosetests", "-v", "-s", testname]
+    return subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        env=test_environment(configfile), preexec_fn=os.setsid)
+
+
+def test_module(testname):
+    """ Return the module part of a test id (module:Class.method) """
+    return testname.split(':', 1)[0]
+
+
+def batch_tests(tests, batch_size=None, by_module=True):
+    """ Group tests into batches that are run by a single nosetests process.
+
+    Tests are grouped by their module if by_module is set, and every batch
+    holds at most batch_size tests if given. Batches with a single test are
+    returned as plain test names, all others as tuples. """
+    groups = collections.OrderedDict()
+    for test in tests:
+        key = test_module(test) if by_module else None
+        groups.setdefault(key, []).append(test)
+
+    batches = []
+    for group in groups.values():
+        size = batch_size or len(group)
+        for start in range(0, len(group), size):
+            batch = group[start:start + size]
+            if len(batch) == 1:
+                batches.append(batch[0])
+            else:
+                batches.append(tuple(batch))
+    return batches
+
+
+def parse_xunit_file(filename):
+    """ Parse a nose xunit report into a list of testcases.
+
+    Each testcase is returned as (test id, status, output) tuple, status is
+    one of 'ok', 'SKIP', 'FAIL' or 'ERROR'. """
+    testcases = []
+    for case in ElementTree.parse(filename).getroot().iter('testcase'):
+        test_id = "%s.%s" % (case.get('classname'), case.get('name'))
+        status = 'ok'
+        output = []
+        for child in case:
+            if child.tag in ('system-out', 'system-err'):
+                output.append(child.text or '')
+            elif child.tag == 'skipped':
+                status = 'SKIP'
+            elif child.tag in ('failure', 'error'):
+                status = 'FAIL' if child.tag == 'failure' else 'ERROR'
+                output.append(child.text or child.get('message', ''))
+        output.append("%s ... %s\n" % (test_id, status))
+        testcases.append((test_id, status, ''.join(output)))
+    return testcases
+
+
+def testcase_belongs_to(test_id, testname):
+    """ Return True if the nose test id is part of the given test name """
+    prefix = testname.replace(':', '.')
+    return (test_id == prefix or test_id.startswith(prefix + '.') or
+            test_id.startswith(prefix + '('))
+
+
+def batch_results(testnames, xunit_file):
+    """ Split the result of a batch into its tests using the xunit report of
+    nose, which also contains the captured output of each testcase.
+
+    Returns a list of (testname, success, output) tuples and the list of
+    tests without any testcase in the report, for example because the module
+    couldn't be imported or the batch was killed. These have to be run again
+    on their own, regardless of the exit code of the batch. The report is
+    removed. """
     try:
-        output = subprocess.check_output(
-            ["nosetests", "-v", "-s", testname],
-            stderr=subprocess.STDOUT)
-        success = True
-        output = output
-    except subprocess.CalledProcessError, error:
-        output = error.output
+        testcases = parse_xunit_file(xunit_file)
+    except (IOError, ElementTree.ParseError):
+        testcases = []
+    finally:
+        if os.path.exists(xunit_file):
+            os.remove(xunit_file)
+
+    test_results = []
+    missing = []
+    for testname in testnames:
+        cases = [case for case in testcases
+                 if testcase_belongs_to(case[0], testname)]
+        if not cases:
+            missing.append(testname)
+            continue
+        success = all(status in ('ok', 'SKIP') for _, status, _ in cases)
+        output = ''.join(case_output for _, _, case_output in cases)
+        test_results.append((testname, success, output))
+    return test_results, missing
+
+
+def parse_subtest(line):
+    """ Return the name of a successful subtest if the line reports one """
+    match = re.match('(.*) \.\.\. ok$', line.rstrip('\n'))
+    if match:
+        return match.group(1)
+    return None
+
+
+def parse_subtests(output):
+    """ Return the names of all successful subtests found in the output """
+    return [subtest for subtest in map(parse_subtest, spool.lines(output))
+            if subtest]
+
+
+def stream_line(cloud, testname, line):
+    """ Log a line of a running test and record its successful subtests.
+    Lines are prefixed with the test, as the outputs of concurrent tests
+    are interleaved in the log. """
+    logging.getLogger('tempest_report').debug(
+        "%s: %s" % (testname, line.rstrip('\n')))
+    subtest = parse_subtest(line)
+    if subtest:
+        cloud.results.add_subtests([subtest])
+
+
+def record_result(cloud, testname, success, output, duration, usage=None,
+                  streamed=False, verbose=False, multiple=False):
+    """ Store the result of a finished test in its CloudRun. The output is
+    logged and parsed for subtests unless it was streamed. """
+    logger = logging.getLogger('tempest_report')
+
+    if cloud.durations is not None:
+        cloud.durations.record(testname, duration)
+    cloud.results.add(testname, success, output, duration, usage=usage)
+
+    if not streamed:
+        logger.debug(output)
+        cloud.results.add_subtests(parse_subtests(output))
 
-    os.environ.clear()
-    os.environ.update(_environ)
+    if success:
+        msg = "OK:  %s" % testname
+    else:
+        msg = "ERR: %s" % testname
+    if multiple:
+        msg = "%s (%s)" % (msg, cloud.name)
 
-    return (success, output)
+    if verbose:
+        logger.info(msg)
+    else:
+        logger.debug(msg)
 
 
-def worker(queue, successful_tests, successful_subtests, junit_tests,
-           verbose=False):
-    """ Single worker which will be executed as thread """
+def worker(queue, clouds, verbose=False, execute=None, deadline=None):
+    """ Single worker which will be executed as thread
+
+    clouds maps the config file of the queued tests to their CloudRun,
+    which collects the results. execute is called as execute(testname,
+    configfile) to run a single test and defaults to executer, whose output
+    is parsed while the test is running. No further test is started once
+    the time.time() deadline passed. """
 
-    logger = logging.getLogger('tempest_report')
     while True:
+        if deadline is not None and time.time() >= deadline:
+            break
         try:
             testname, configfile_name = queue.get_nowait()
         except Queue.Empty:
             break
 
-        success, output = executer(testname, configfile_name)
-        junit_tests.append((testname, output, success))
-
-        logger.debug(output)
-
-        if success:
-            successful_tests.append(testname)
-            msg = "OK:  %s" % testname
-        else:
-            msg = "ERR: %s" % testname
-
-        lineend_ok = re.compile('(.*) \.\.\. ok$')
-        for line in output.split('\n'):
-            match = lineend_ok.match(line)
-            if match and match not in successful_tests:
-                successful_subtests.append(match.group(1))
-
-        if verbose:
-            logger.info(msg)
-        else:
-            logger.debug(msg)
-
-        queue.task_done()
+        cloud = clouds[configfile_name]
+        # The prefork servers only know the main config file
+        if not execute:
+            configfile_name = cloud.acquire_config()
 
+        def on_line(line):
+            stream_line(cloud, testname, line)
 
-def main(options):
-    now = datetime.datetime.now()
-    logfile = "tempest-report-%s.log" % now.strftime("%Y%m%d-%H%M%S")
-    print "Full test output logged to %s" % logfile
-
+        try:
+            start = time.time()
+            streamed = False
+            usage = None
+            if execute:
+                success, output = execute(testname, configfile_name)
+                test_results = [(testname, success, output)]
+            else:
+                usage = results.ResourceUsage()
+                success, output = executer(testname, configfile_name,
+                                           on_line=on_line, usage=usage)
+                test_results = [(testname, success, output)]
+                streamed = True
+            duration = (time.time() - start) / len(test_results)
+
+            for testname, success, output in test_results:
+                record_result(cloud, testname, success, output, duration,
+                              usage, streamed, verbose, len(clouds) > 1)
+        finally:
+            if not execute:
+                cloud.release_config(configfile_name)
+            queue.task_done()
+
+
+def run_supervised(queue, clouds, options, deadline=None):
+    """ Run the queued tests and batches with a supervisor.Supervisor
+    instead of worker threads. Tests of a batch missing in its report are
+    queued again on their own. Returns False if the run stopped early. """
     logger = logging.getLogger('tempest_report')
-    logger.setLevel(logging.DEBUG)
-    logger.propagate = False
-
-    logfile = logging.FileHandler(logfile)
-    logfile.setLevel(logging.DEBUG)
-
-    console = logging.StreamHandler()
-    console.setLevel(logging.INFO)
-
-    logger.addHandler(console)
-    logger.addHandler(logfile)
+    # Config files used by the running tests and xunit reports of the
+    # running batches, by queued item
+    in_use = {}
+    xunit_files = {}
+
+    def start(testname, configfile):
+        in_use[(testname, configfile)] = clouds[configfile].acquire_config()
+        xunit_file = None
+        if isinstance(testname, tuple):
+            handle, xunit_file = tempfile.mkstemp(
+                prefix='tempest_report_xunit_', suffix='.xml')
+            os.close(handle)
+            xunit_files[(testname, configfile)] = xunit_file
+        return start_test(testname, in_use[(testname, configfile)],
+                          xunit_file)
+
+    def on_line(item, line):
+        stream_line(clouds[item[1]], item[0], line)
+
+    def on_result(item, success, output, duration, usage):
+        testname, configfile = item
+        cloud = clouds[configfile]
+        if item in in_use:
+            cloud.release_config(in_use.pop(item))
+        if not isinstance(testname, tuple):
+            record_result(cloud, testname, success, output, duration, usage,
+                          streamed=True, verbose=options.verbose,
+                          multiple=len(clouds) > 1)
+            return
+
+        test_results = []
+        missing = list(testname)
+        if item in xunit_files:
+            test_results, missing = batch_results(testname,
+                                                  xunit_files.pop(item))
+        for name, test_success, test_output in test_results:
+            record_result(cloud, name, test_success, test_output,
+                          duration / len(testname), verbose=options.verbose,
+                          multiple=len(clouds) > 1)
+        for name in missing:
+            expected = 0
+            if cloud.durations:
+                expected = cloud.durations.expected(name)
+            queue.put((name, configfile), expected)
+
+    runner = supervisor.Supervisor(
+        queue, start, int(options.workers), on_line, on_result,
+        new_output=BoundedOutput, test_timeout=options.test_timeout,
+        deadline=deadline, max_line_size=MAX_LINE_SIZE)
+    try:
+        finished = runner.run()
+    finally:
+        # Reports of batches left without a result by an aborted run
+        for xunit_file in xunit_files.values():
+            os.remove(xunit_file)
+    if finished:
+        return True
+    logger.info("\n%s, %d tests were not started" % (runner.reason,
+                                                     queue.qsize()))
+    return False
+
+
+class CloudRun(object):
+    """ Credentials, config and results of the tests of a single cloud """
+
+    def __init__(self, name, username, password, auth_url,
+                 tenant_name=None, region_name=None, is_admin=False):
+        self.name = name
+        self.username = username
+        self.password = password
+        self.auth_url = auth_url
+        self.tenant_name = tenant_name
+        self.region_name = region_name
+        self.is_admin = is_admin
+
+        self.users = None
+        self.tenant_pool = None
+        # The main config file and one per worker with its own users
+        self.configfile = None
+        self.configfiles = []
+        self.free_configs = []
+        self.config_lock = threading.Lock()
+        self.durations = None
+        self.result_cache = None
+        self.all_tests = []
+        self.queued_tests = []
+        self.splits = {}
+        self.results = results.ResultStore()
+        self.reporters = []
+        # Why the cloud couldn't be prepared, its tests didn't run
+        self.error = None
+
+    @property
+    def key(self):
+        return storage.cloud_key(self.auth_url, self.tenant_name,
+                                 self.region_name)
+
+    def add_reporter(self, reporter):
+        """ Pass the result of every test to a reporters.Reporter """
+        self.reporters.append(reporter)
+        self.results.listeners.append(reporter.add)
+
+    def acquire_config(self):
+        """ Return a config file whose users aren't used by another running
+        test. All tests share the main config file without a tenant pool.
+        """
+        with self.config_lock:
+            if self.free_configs:
+                return self.free_configs.pop()
+        return self.configfile
+
+    def release_config(self, configfile):
+        with self.config_lock:
+            if (len(self.configfiles) > 1 and
+                    configfile not in self.free_configs):
+                self.free_configs.append(configfile)
+
+
+def load_inventory(fname, options):
+    """ Load the clouds of an inventory file.
+
+    Every section of the ini file is a cloud, with the options os_username,
+    os_password and os_auth_url and the optional os_tenant_name,
+    os_region_name and admin. """
+    inventory = ConfigParser.SafeConfigParser()
+    with open(fname) as inventory_file:
+        inventory.readfp(inventory_file)
+
+    def get(section, option, default=None):
+        if inventory.has_option(section, option):
+            return inventory.get(section, option)
+        return default
+
+    clouds = []
+    for section in inventory.sections():
+        is_admin = options.is_admin
+        if inventory.has_option(section, 'admin'):
+            is_admin = inventory.getboolean(section, 'admin')
+        clouds.append(CloudRun(section,
+                               inventory.get(section, 'os_username'),
+                               inventory.get(section, 'os_password'),
+                               inventory.get(section, 'os_auth_url'),
+                               get(section, 'os_tenant_name'),
+                               get(section, 'os_region_name'),
+                               is_admin))
+    return clouds
+
+
+def tempest_index():
+    """ Return the static index of the installed tempest tests """
+    return index.load_index(tempest.__path__[0], prefix="tempest.",
+                            cache_path=storage.state_path('index.json'))
+
+
+def split_tests(tests, test_index, granularity, durations=None,
+                threshold=0):
+    """ Split modules into class (module:Class) or method
+    (module:Class.method) ids, so long modules are spread over the workers.
+
+    Only modules expected to run longer than threshold seconds are split,
+    nothing is split without durations. Modules with module-level test
+    functions are never split. Modules with a class inheriting test methods
+    are split into classes, as the inherited tests are not part of the
+    index. Returns the tests to queue and a dict mapping every split module
+    to its parts. """
+    queued_tests = []
+    splits = {}
+    for test in tests:
+        classes = test_index.classes(test)
+        if (':' in test or not classes or test_index.functions(test) or
+                durations is None or
+                durations.expected(test) <= threshold):
+            queued_tests.append(test)
+            continue
+
+        if granularity == 'class' or test_index.inherits_tests(test):
+            parts = ['%s:%s' % (test, cls) for cls in sorted(classes)]
+        else:
+            parts = test_index.methods(test)
+        splits[test] = parts
+        queued_tests.extend(parts)
+    return queued_tests, splits
 
-    keystone = keystoneclient.v2_0.client.Client(username=options.os_username,
-                                                 password=options.os_password,
-                                                 auth_url=options.os_auth_url)
-    tenants = keystone.tenants.findall()
 
-    tenant_name = options.os_tenant_name
-    if tenant_name is None:
-        if len(tenants) > 1:
-            print "Found %d tenants, using %s for current job." % (
-                len(tenants), tenants[0].name)
-            print "Please set other tenant on command line if required. "
-        tenant_name = tenants[0].name
-
-    users = {'admin_user': {'username': options.os_username,
-                            'password': options.os_password,
-                            'tenant_name': tenant_name},
-             'first_user': {'username': options.os_username,
-                            'password': options.os_password,
-                            'tenant_name': tenant_name},
-             'second_user': {'username': options.os_username,
-                             'password': options.os_password,
-                             'tenant_name': tenant_name}
-             }
-
-    if options.is_admin:
-        users['first_user'] = create_tenant_and_user(options.os_username,
-                                                     options.os_password,
-                                                     options.os_auth_url,
-                                                     tenant_name)
-
-        users['second_user'] = create_tenant_and_user(options.os_username,
-                                                      options.os_password,
-                                                      options.os_auth_url,
-                                                      tenant_name)
-
-    config = customized_tempest_conf(users, options.os_auth_url)
-
-    configfile = tempfile.NamedTemporaryFile(delete=False)
-    with configfile:
-        configfile.write(config)
-
-    queue = Queue.Queue()
-    successful_tests = []
-    successful_subtests = []
-    junit_tests = []
+def select_tests(options, excluded_tests):
+    """ Return the names of all tests to run """
     all_tests = []
-
-    excluded_tests = load_excluded_tests(options.exclude)
-
     if not options.fullrun:
         for test, values in settings.description_list.items():
             test_level = values.get('level', 1)
@@ -300,67 +626,317 @@ def main(options):
                     int(release_level) <= int(options.max_release_level) and
                     not dummy and
                     not test_is_excluded(test, excluded_tests)):
-                queue.put((test, configfile.name))
                 all_tests.append(test)
     else:
-        packages = pkgutil.walk_packages(tempest.__path__, prefix="tempest.")
-        for _importer, testname, _ispkg in packages:
+        for testname in tempest_index().module_names():
             if ("test_" in testname and
                     not test_is_excluded(testname, excluded_tests)):
-                queue.put((testname, configfile.name))
                 all_tests.append(testname)
+    return all_tests
 
-    threads = []
-    for _nr in range(4):
-        thread = threading.Thread(target=worker,
-                                  args=(queue,
-                                        successful_tests,
-                                        successful_subtests,
-                                        junit_tests,
-                                        options.verbose))
-        thread.daemon = True
-        thread.start()
-        threads.append(thread)
 
-    while True:
-        try:
-            if len([t for t in threads if t.isAlive()]) == 0:
-                break
-            time.sleep(1)
-        except KeyboardInterrupt:
-            break
+def prepare_cloud(cloud, options, all_tests, token_cache=None):
+    """ Create the tempest config of a cloud and select the tests to run """
+    logger = logging.getLogger('tempest_report')
 
-    os.remove(configfile.name)
-    if options.is_admin:
-        delete_tenant_and_user(options.os_username,
-                               options.os_password,
-                               options.os_auth_url,
-                               tenant_name,
-                               users['first_user'])
-        delete_tenant_and_user(options.os_username,
-                               options.os_password,
-                               options.os_auth_url,
-                               tenant_name,
-                               users['second_user'])
+    if cloud.tenant_name is None:
+        keystone = auth.get_client(cloud.username, cloud.password,
+                                   cloud.auth_url, token_cache=token_cache)
+        tenant_list = keystone.tenants.findall()
+        if len(tenant_list) > 1:
+            print "Found %d tenants, using %s for %s." % (
+                len(tenant_list), tenant_list[0].name, cloud.name)
+            print "Please set other tenant on command line if required. "
+        cloud.tenant_name = tenant_list[0].name
+
+    user = {'username': cloud.username,
+            'password': cloud.password,
+            'tenant_name': cloud.tenant_name}
+    cloud.users = {'admin_user': dict(user),
+                   'first_user': dict(user),
+                   'second_user': dict(user)}
+
+    # Every worker uses its own pair as first and the next one as second
+    # user, with at least two pairs for a single worker
+    pairs = []
+    if cloud.is_admin:
+        cloud.tenant_pool = tenants.TenantPool(
+            options.tenant_pool, cloud.key, cloud.username, cloud.password,
+            cloud.auth_url, cloud.tenant_name, token_cache)
+        pairs = cloud.tenant_pool.acquire(max(int(options.workers), 2))
+        cloud.users['first_user'] = pairs[0]
+        cloud.users['second_user'] = pairs[1]
+
+    context = discover.DiscoveryContext(cloud.username,
+                                        cloud.password,
+                                        cloud.tenant_name,
+                                        cloud.auth_url,
+                                        cloud.region_name,
+                                        token_cache)
+    config = customized_tempest_conf(cloud.users, cloud.auth_url,
+                                     region_name=cloud.region_name,
+                                     context=context)
+
+    for nr in range(max(len(pairs), 1)):
+        if nr > 0:
+            users = dict(cloud.users, first_user=pairs[nr],
+                         second_user=pairs[(nr + 1) % len(pairs)])
+            config = discover.config_for_users(config, users)
+        configfile = tempfile.NamedTemporaryFile(delete=False)
+        with configfile:
+            configfile.write(config)
+        cloud.configfiles.append(configfile.name)
+    cloud.configfile = cloud.configfiles[0]
+    if len(cloud.configfiles) > 1:
+        cloud.free_configs = list(reversed(cloud.configfiles))
+
+    if options.history:
+        cloud.durations = history.DurationHistory(options.history, cloud.key)
+
+    cloud.all_tests = list(all_tests)
+    cloud.queued_tests = list(all_tests)
+    if options.incremental:
+        cloud.result_cache = fingerprint.ResultCache(
+            storage.state_path('results-%s.json' % cloud.key),
+            fingerprint.cloud_fingerprints(context))
+        cloud.queued_tests = []
+        for test in all_tests:
+            if cloud.result_cache.unchanged(test):
+                success, output, subtests = cloud.result_cache.get(test)
+                cloud.results.add(test, success, output)
+                cloud.results.add_subtests(subtests)
+            else:
+                cloud.queued_tests.append(test)
+        logger.info("Reusing results of %d tests of unchanged services" %
+                    (len(all_tests) - len(cloud.queued_tests)))
+
+    if options.fast_discovery:
+        outputs = extensions.fast_discovery(context, cloud.queued_tests)
+        for testname, output in outputs.items():
+            logger.debug(output)
+            cloud.results.add(testname, True, output)
+            cloud.results.add_subtests(parse_subtests(output))
+        cloud.queued_tests = [test for test in cloud.queued_tests
+                              if test not in outputs]
+
+
+def finish_cloud(cloud):
+    """ Store the results of a cloud and remove its config and users """
+    try:
+        if cloud.error is None:
+            for testname, parts in cloud.splits.items():
+                record = cloud.results.merge(testname, parts)
+                if cloud.durations is not None:
+                    cloud.durations.record(testname, record.duration)
+            if cloud.durations:
+                cloud.durations.save()
+            if cloud.result_cache:
+                for record in cloud.results:
+                    cloud.result_cache.add(record.testname, record.success,
+                                           spool.excerpt(record.output),
+                                           parse_subtests(record.output))
+                cloud.result_cache.save()
+    finally:
+        for configfile in cloud.configfiles:
+            os.remove(configfile)
+        cloud.configfiles = []
+        if cloud.tenant_pool:
+            cloud.tenant_pool.release()
+
+
+def usage_table(records, count=10):
+    """ Return a table of the count slowest tests and of the count tests
+    with the longest time until their first output """
+    def row(record):
+        usage = record.usage or results.ResourceUsage()
+        first_output = usage.first_output
+        return "%8.1f %8.1f %8s %10d  %s" % (
+            record.duration or 0, usage.cpu,
+            '-' if first_output is None else '%.1f' % first_output,
+            usage.max_rss, record.testname)
+
+    header = "%8s %8s %8s %10s  %s" % ('wall s', 'cpu s', 'first s',
+                                       'max rss kB', 'test')
+    slowest = sorted(records, key=lambda record: record.duration or 0,
+                     reverse=True)[:count]
+    overhead = sorted([record for record in records
+                       if record.usage and
+                       record.usage.first_output is not None],
+                      key=lambda record: record.usage.first_output,
+                      reverse=True)[:count]
+
+    table = "\nSlowest tests:\n%s\n" % header
+    table += ''.join("%s\n" % row(record) for record in slowest)
+    if overhead:
+        table += "\nHighest overhead (time to first output):\n%s\n" % header
+        table += ''.join("%s\n" % row(record) for record in overhead)
+    return table
+
+
+def report_cloud(cloud, options, now, multiple=False):
+    """ Log the summary of a cloud and pass it to its reporters """
+    logger = logging.getLogger('tempest_report')
+
+    if multiple:
+        logger.info("\n%s\n%s" % (cloud.name, '=' * len(cloud.name)))
+
+    if cloud.error is not None:
+        logger.info("\nFailed to prepare %s, no tests were run: %s" %
+                    (cloud.name, cloud.error))
 
     failed_tests = '\n'.join(sorted(
-        [t for t in all_tests if t not in successful_tests]))
+        cloud.results.failed_tests(cloud.all_tests)))
     if failed_tests:
         logger.info("\nFailed tests:\n%s" % failed_tests)
 
+    successful_tests = cloud.results.successful_tests
     if successful_tests:
         logger.info("\nSuccessful tests:\n%s" %
                     ('\n'.join(sorted(successful_tests))))
 
     summary = ""
-    passed_tests = successful_tests + successful_subtests
-    for _, service in sorted(service_summary(passed_tests).items()):
+    passed_tests = successful_tests + cloud.results.successful_subtests
+    services = service_summary(passed_tests)
+    for _, service in sorted(services.items()):
         summary += "\n%s: %s\n" % (service.name, service.release_name)
         for feature in service.get_features():
             summary += "\t\t\t\t%s\n" % (feature,)
     logger.info(summary)
 
-    if options.junit:
-        print "Writting junit test reports to %s" % options.junit
-        junit_title = "tempest-report (%s)" % now.strftime("%Y%m%d-%H%M%S")
-        gen_junit_file(options.junit, junit_title, junit_tests)
+    records = list(cloud.results)
+    if options.slowest and records:
+        logger.info(usage_table(records, options.slowest))
+
+    for reporter in cloud.reporters:
+        reporter.add_summary(services, passed_tests)
+
+
+def main(options):
+    now = datetime.datetime.now()
+    logfile = "tempest-report-%s.log" % now.strftime("%Y%m%d-%H%M%S")
+    print "Full test output logged to %s" % logfile
+
+    logger = logging.getLogger('tempest_report')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+    logfile = logging.FileHandler(logfile)
+    logfile.setLevel(logging.DEBUG)
+
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+
+    logger.addHandler(console)
+    logger.addHandler(logfile)
+
+    if options.inventory:
+        clouds = load_inventory(options.inventory, options)
+    else:
+        clouds = [CloudRun(options.os_auth_url,
+                           options.os_username,
+                           options.os_password,
+                           options.os_auth_url,
+                           options.os_tenant_name,
+                           options.os_region_name,
+                           options.is_admin)]
+
+    excluded_tests = load_excluded_tests(options.exclude)
+    all_tests = select_tests(options, excluded_tests)
+    if options.exclude_report:
+        with open(options.exclude_report, 'w') as report:
+            report.write(excluded_tests.report())
+
+    token_cache = None
+    if options.token_cache:
+        token_cache = auth.TokenCache(options.token_cache)
+
+    queue = scheduler.Scheduler(
+        class_limits=dict(settings.resource_limits,
+                          heavy=options.heavy_limit or
+                          settings.resource_limits.get('heavy')))
+
+    execute = None
+    if options.engine == 'prefork':
+        execute = prefork.PreforkExecuter(timeout=options.test_timeout)
+
+    multiple = len(clouds) > 1
+    try:
+        for cloud in clouds:
+            if options.junit:
+                junit_file, junit_title = junit_report(options, cloud, now,
+                                                       multiple)
+                print "Writting junit test reports to %s" % junit_file
+                cloud.add_reporter(reporters.JUnitWriter(junit_file,
+                                                         junit_title))
+            if options.subunit:
+                subunit_file = report_path(options.subunit, cloud, multiple)
+                print "Writing subunit stream to %s" % subunit_file
+                cloud.add_reporter(reporters.SubunitWriter(subunit_file))
+            if options.ndjson:
+                ndjson_file = report_path(options.ndjson, cloud, multiple)
+                print "Writing NDJSON report to %s" % ndjson_file
+                cloud.add_reporter(reporters.NDJSONWriter(ndjson_file,
+                                                          cloud.name, now))
+
+            try:
+                prepare_cloud(cloud, options, all_tests, token_cache)
+            except Exception, error:
+                logger.exception("Failed to prepare %s" % cloud.name)
+                cloud.error = str(error) or error.__class__.__name__
+                continue
+
+            queued_tests = cloud.queued_tests
+            if options.split != 'module':
+                queued_tests, cloud.splits = split_tests(
+                    queued_tests, tempest_index(), options.split,
+                    cloud.durations, options.split_threshold)
+
+            if execute:
+                execute.start(cloud.configfile)
+            elif options.batch or options.batch_size:
+                queued_tests = batch_tests(queued_tests, options.batch_size,
+                                           options.batch)
+
+            for test in queued_tests:
+                duration = 0
+                if cloud.durations:
+                    duration = cloud.durations.expected(test)
+                queue.put((test, cloud.configfile), duration)
+
+        deadline = None
+        if options.deadline:
+            deadline = time.time() + options.deadline
+        configs = dict((cloud.configfile, cloud) for cloud in clouds
+                       if cloud.error is None)
+
+        if execute is None:
+            run_supervised(queue, configs, options, deadline)
+        else:
+            threads = []
+            for _nr in range(int(options.workers)):
+                thread = threading.Thread(target=worker,
+                                          args=(queue, configs,
+                                                options.verbose, execute,
+                                                deadline))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+            try:
+                for thread in threads:
+                    # A timeout keeps the wait interruptible by Ctrl-C
+                    while thread.isAlive():
+                        thread.join(1)
+            except KeyboardInterrupt:
+                pass
+    finally:
+        if execute:
+            execute.stop()
+        for cloud in clouds:
+            finish_cloud(cloud)
+
+    for cloud in clouds:
+        report_cloud(cloud, options, now, multiple)
+        for reporter in cloud.reporters:
+            reporter.close()
+        cloud.results.close()
@@ -0,0 +1,337 @@
+# Copyright (C) 2014 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+""" Benchmarks of the hot paths and of the whole harness, run with:
+
+    python tests/benchmarks.py [--tests <count>] [--workers <number>]
+                               [--latency <seconds>] [--lines <number>]
+                               [--failures <ratio>]
+
+The harness benchmark runs utils.main against tests/fake_nosetests with a
+stubbed keystone, once per --tests plan (default 100, 1000 and 10000), and
+reports the throughput, the time from the last finished test to the end of
+the run and the peak memory of the harness process.
+"""
+
+import collections
+import json
+import logging
+import optparse
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import mock
+
+from tempest_report import exclude
+from tempest_report import fleet
+from tempest_report import results
+from tempest_report import scheduler
+from tempest_report import settings
+from tempest_report import trie
+from tempest_report import utils
+
+
+def synthetic_test_ids(count, seed=42):
+    """ Return test ids looking like the ones of a full run: test modules,
+    verbose nose lines of test methods and extension subtests """
+    rand = random.Random(seed)
+    prefixes = sorted(settings.service_names) + ['tempest.api.volume',
+                                                 'tempest.thirdparty']
+    ids = []
+    for nr in range(count):
+        prefix = rand.choice(prefixes)
+        kind = nr % 3
+        if kind == 0:
+            ids.append("%s.test_module_%d" % (prefix, nr))
+        elif kind == 1:
+            ids.append("test_method_%d (%s.test_module.Test)" % (nr, prefix))
+        else:
+            ids.append("%s-alias-%d" % (rand.choice(['nova-extension',
+                                                     'neutron-extension',
+                                                     'ceilometer-meter']),
+                                        nr))
+    return ids
+
+
+def scan_service_summary(successful_tests):
+    """ Former implementation of utils.service_summary, scanning every
+    prefix of settings.service_names for every test """
+    services = {}
+    for test in successful_tests:
+        service = [service
+                   for prefix, service in settings.service_names.items()
+                   if prefix in str(test)]
+        if service:
+            service_name = service[0]
+            if service_name not in services:
+                services[service_name] = utils.ServiceSummary(service_name)
+            result = settings.description_list.get(str(test))
+            if result:
+                services[service_name].set_release(result.get('release', 0))
+                services[service_name].add_feature(result.get('feature'))
+    return services
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def bench_service_summary(count=100000, extra_prefixes=0):
+    ids = synthetic_test_ids(count)
+    service_names = settings.service_names
+    services = scheduler.SERVICES
+    settings.service_names = dict(service_names)
+    for nr in range(extra_prefixes):
+        settings.service_names['tempest.api.extra.test_%d' % nr] = 'Extra'
+    scheduler.SERVICES = trie.PrefixTrie(settings.service_names)
+    try:
+        scan = timed(scan_service_summary, ids)
+        lookup = timed(utils.service_summary, ids)
+    finally:
+        settings.service_names = service_names
+        scheduler.SERVICES = services
+    print "service_summary of %d test ids, %d prefixes:" % (
+        count, len(service_names) + extra_prefixes)
+    print "  prefix scan:   %.3fs" % scan
+    print "  prefix trie:   %.3fs (%.1fx)" % (lookup, scan / lookup)
+
+
+def bench_failed_tests(count=20000):
+    ids = ["tempest.api.compute.test_module_%d" % nr for nr in range(count)]
+    successful_tests = ids[::2]
+    store = results.ResultStore()
+    for nr, testname in enumerate(ids):
+        store.add(testname, nr % 2 == 0, '')
+
+    scan = timed(lambda: [t for t in ids if t not in successful_tests])
+    indexed = timed(store.failed_tests, ids)
+    print "failed tests of %d tests:" % count
+    print "  list scan:     %.3fs" % scan
+    print "  result store:  %.3fs (%.1fx)" % (indexed, scan / indexed)
+
+
+def bench_exclude(count=20000, lines=300):
+    ids = synthetic_test_ids(count)
+    patterns = ["test_module_%d" % nr for nr in range(0, count, 67)][:lines]
+    patterns.append(r"^tempest\.thirdparty\..*boto")
+    regexps = [re.compile(pattern) for pattern in patterns]
+    matcher = exclude.ExcludeMatcher(enumerate(patterns, 1))
+
+    def scan():
+        return [t for t in ids if any(regex.search(t) for regex in regexps)]
+
+    def combined():
+        return [t for t in ids if matcher.match(t) is not None]
+
+    print "exclude %d test ids with %d lines:" % (count, len(patterns))
+    scanned = timed(scan)
+    matched = timed(combined)
+    print "  regex list:    %.3fs" % scanned
+    print "  matcher:       %.3fs (%.1fx)" % (matched, scanned / matched)
+
+
+def bench_fleet(clouds=500, runs=6, seed=42):
+    rand = random.Random(seed)
+    tests = sorted(settings.description_list)
+    history = [("cloud-%d" % (nr % clouds), nr // clouds,
+                rand.sample(tests, rand.randint(0, len(tests))))
+               for nr in range(clouds * runs)]
+
+    def summaries():
+        latest = {}
+        for cloud, started, passed in history:
+            latest[cloud] = utils.service_summary(passed)
+        releases = collections.defaultdict(collections.Counter)
+        for services in latest.values():
+            for name, service in services.items():
+                releases[name][service.release] += 1
+        return releases
+
+    def aggregated():
+        aggregate = fleet.Fleet()
+        for cloud, started, passed in history:
+            aggregate.add_run(cloud, started, passed)
+        return aggregate.releases(), aggregate.coverage()
+
+    print "release distribution of %d clouds, %d runs each:" % (clouds, runs)
+    summarized = timed(summaries)
+    bitsets = timed(aggregated)
+    print "  service_summary: %.3fs" % summarized
+    print "  fleet bitsets:   %.3fs (%.1fx, including coverage)" % (
+        bitsets, summarized / bitsets)
+
+
+FAKE_NOSETESTS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'fake_nosetests')
+
+
+def synthetic_plan(count, failures=0.1, seed=42):
+    """ Return a description_list of count tests, names ending with _fail
+    make fake_nosetests fail """
+    rand = random.Random(seed)
+    prefixes = sorted(settings.service_names)
+    plan = {}
+    for nr in range(count):
+        testname = "%s.test_bench_%d" % (rand.choice(prefixes), nr)
+        if rand.random() < failures:
+            testname += '_fail'
+        plan[testname] = {}
+    return plan
+
+
+def harness_options(tempdir, workers):
+    def options():
+        pass
+    options.os_username = "username"
+    options.os_password = "password"
+    options.os_auth_url = "http://keystone:5000/v2.0"
+    options.os_tenant_name = "tenant_name"
+    options.os_region_name = None
+    options.fullrun = False
+    options.level = 1
+    options.max_release_level = sys.maxint
+    options.verbose = False
+    options.exclude = None
+    options.exclude_report = None
+    options.junit = os.path.join(tempdir, 'junit.xml')
+    options.subunit = None
+    options.ndjson = None
+    options.slowest = 10
+    options.is_admin = False
+    options.batch = False
+    options.batch_size = None
+    options.split = 'module'
+    options.split_threshold = 600
+    options.engine = 'subprocess'
+    options.workers = workers
+    options.heavy_limit = None
+    options.history = None
+    options.incremental = False
+    options.inventory = None
+    options.token_cache = None
+    options.fast_discovery = False
+    options.test_timeout = None
+    options.deadline = None
+    options.tenant_pool = None
+    return options
+
+
+def run_harness(count, workers, latency, lines, failures):
+    """ Run utils.main on a synthetic plan and return its figures """
+    tempdir = tempfile.mkdtemp(prefix='tempest_report_bench_')
+    os.symlink(FAKE_NOSETESTS, os.path.join(tempdir, 'nosetests'))
+    os.environ['PATH'] = tempdir + os.pathsep + os.environ['PATH']
+    os.environ['FAKE_NOSETESTS_LATENCY'] = str(latency)
+    os.environ['FAKE_NOSETESTS_LINES'] = str(lines)
+    os.chdir(tempdir)
+    # The summary lists every test on the console
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+
+    finished = []
+    record_result = utils.record_result
+
+    def timed_record_result(*args, **kwargs):
+        record_result(*args, **kwargs)
+        finished.append(time.time())
+
+    options = harness_options(tempdir, workers)
+    try:
+        with mock.patch('tempest_report.settings.description_list',
+                        synthetic_plan(count, failures)), \
+                mock.patch('keystoneclient.v2_0.client.Client'), \
+                mock.patch('tempest_report.discover.DiscoveryContext'), \
+                mock.patch('tempest_report.utils.customized_tempest_conf',
+                           return_value=''), \
+                mock.patch('tempest_report.utils.record_result',
+                           timed_record_result):
+            start = time.time()
+            utils.main(options)
+            end = time.time()
+    finally:
+        for handler in logging.getLogger('tempest_report').handlers[:]:
+            logging.getLogger('tempest_report').removeHandler(handler)
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+    return {'tests': count,
+            'duration': end - start,
+            'end_latency': end - max(finished),
+            'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def in_child(function, *args):
+    """ Return the result of function run in a forked process, so the peak
+    memory of every run is measured on its own """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            with os.fdopen(write_fd, 'w') as pipe:
+                json.dump(function(*args), pipe)
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        data = pipe.read()
+    os.waitpid(pid, 0)
+    return json.loads(data) if data else None
+
+
+def bench_harness(counts, workers=8, latency=0, lines=0, failures=0.1):
+    print "harness with %d workers, %ss latency and %d output lines " \
+        "per test:" % (workers, latency, lines)
+    for count in counts:
+        result = in_child(run_harness, count, workers, latency, lines,
+                          failures)
+        if result is None:
+            print "  %7d tests:  failed" % count
+            continue
+        print "  %7d tests:  %8.1f tests/s, %.2fs end of run, " \
+            "%d kB max rss" % (count, count / result['duration'],
+                               result['end_latency'], result['max_rss'])
+
+
+def parse_args(args):
+    parser = optparse.OptionParser()
+    parser.add_option('--tests', type="int", action="append", dest="tests",
+                      help='Number of tests of a harness run, can be given '
+                           'several times. Defaults to 100, 1000 and 10000.')
+    parser.add_option('--workers', type="int", dest="workers", default=8)
+    parser.add_option('--latency', type="float", dest="latency", default=0,
+                      help='Seconds every fake test takes.')
+    parser.add_option('--lines', type="int", dest="lines", default=0,
+                      help='Lines of output of every fake test.')
+    parser.add_option('--failures', type="float", dest="failures",
+                      default=0.1, help='Ratio of failing fake tests.')
+    return parser.parse_args(args)[0]
+
+
+if __name__ == '__main__':
+    options = parse_args(sys.argv[1:])
+    # First, so the forked runs don't inherit the memory of the others
+    bench_harness(options.tests or [100, 1000, 10000], options.workers,
+                  options.latency, options.lines, options.failures)
+    bench_service_summary()
+    bench_service_summary(extra_prefixes=500)
+    bench_failed_tests()
+    bench_exclude()
+    bench_fleet()
@@ -17,12 +17,27 @@
 #pylint: disable=E1101, E1103
 
 from Queue import Empty as QueueEmpty
+import datetime
+import json
+import os
+import shutil
+import socket
+import StringIO
 import subprocess
+import tempfile
+import threading
+import time
 import unittest
+from xml.etree import ElementTree
 
+from keystoneclient.access import AccessInfo
+import keystoneclient.exceptions
 import mock
 
-from tempest_report import utils, settings, discover
+from tempest_report import utils, settings, discover, prefork, scheduler
+from tempest_report import auth, extensions, fingerprint, history, storage
+from tempest_report import exclude, index, reporters, results, spool, trie
+from tempest_report import fleet, supervisor, tenants
 import tempest_report
 
 
@@ -41,22 +56,22 @@ class DummyFileObject(object):
         self.content += content
 
 
-class DummyImage(object):
+class DummyImage(dict):
     def __init__(self, size, disk_format, status, id=23,
                  visibility='public'):
-        self.disk_format = disk_format
-        self.status = status
-        self.id = id
-        self.visibility = visibility
-        self._info = {'OS-EXT-IMG-SIZE:size': size}
+        super(DummyImage, self).__init__({'disk_format': disk_format,
+                                          'status': status,
+                                          'id': id,
+                                          'visibility': visibility,
+                                          'OS-EXT-IMG-SIZE:size': size})
 
 
-class DummyFlavor(object):
+class DummyFlavor(dict):
     def __init__(self, vcpus, disk, ram, id="42"):
-        self.vcpus = vcpus
-        self.disk = disk
-        self.ram = ram
-        self.id = id
+        super(DummyFlavor, self).__init__({'vcpus': vcpus,
+                                           'disk': disk,
+                                           'ram': ram,
+                                           'id': id})
 
 
 class Tenant(object):
@@ -100,48 +115,112 @@ class UtilTest(unittest.TestCase):
 
     fake_creds = ("user", "password", "tenant_name", "http://127.0.0.1:5000")
 
-    @mock.patch('novaclient.client')
-    def test_get_smallest_flavor(self, novaclient):
+    def test_get_smallest_flavor(self):
         sample_flavors = []
         sample_flavors.append(DummyFlavor(1, 1, 128, 42))
         sample_flavors.append(DummyFlavor(1, 0, 64, 43))
         sample_flavors.append(DummyFlavor(1, 1, 64, 44))
 
-        novaclient_cls = novaclient.get_client_class.return_value
-        novaclient_obj = novaclient_cls.return_value
-        novaclient_obj.flavors.list.return_value = sample_flavors
+        context = mock.Mock()
+        context.get.return_value = {'flavors': sample_flavors}
 
-        smallest_flavor = discover.get_smallest_flavor(*self.fake_creds)
+        smallest_flavor = discover.get_smallest_flavor(context)
         self.assertEqual(smallest_flavor, 43)
+        context.get.assert_called_with('compute', 'flavors/detail')
+
+        context.get.side_effect = discover.EndpointNotFound('compute')
+        self.assertEqual(discover.get_smallest_flavor(context), None)
 
     @mock.patch('keystoneclient.v2_0.client.Client')
     def test_get_services(self, keystoneclient):
         keystoneclient.return_value = KeystoneDummy()
-        services = discover.get_services(*self.fake_creds)
+        context = discover.DiscoveryContext(*self.fake_creds)
+        services = discover.get_services(context)
 
         self.assertEqual(services, {'servicetype': 'url'})
 
-    @mock.patch('subprocess.check_output')
-    def test_executer(self, subprocess_mock):
-        subprocess_mock.return_value = "output"
+    @mock.patch('subprocess.Popen')
+    def test_executer(self, popen):
+        popen.return_value.stdout = StringIO.StringIO(
+            "output\nnova-extension-NMN ... ok\n")
+        popen.return_value.wait.return_value = 0
+        lines = []
         success, output = utils.executer(
-            "testname", "/dir/filename")
+            "testname", "/dir/filename", on_line=lines.append)
 
         self.assertTrue(success)
-        self.assertEqual(output, "output")
+        self.assertEqual(output, "output\nnova-extension-NMN ... ok\n")
+        self.assertEqual(lines, ["output\n", "nova-extension-NMN ... ok\n"])
 
-        subprocess_mock.assert_called_with(
+        popen.assert_called_with(
             ["nosetests", "-v", "-s", "testname"],
-            stderr=subprocess.STDOUT)
-
-        subprocess_mock.side_effect = subprocess.CalledProcessError(
-            1, "command", "error")
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=mock.ANY)
+        environ = popen.call_args[1]['env']
+        self.assertEqual(environ['TEMPEST_CONFIG_DIR'], '/dir')
+        self.assertEqual(environ['TEMPEST_CONFIG'], 'filename')
+        self.assertNotIn('TEMPEST_CONFIG', os.environ)
+
+        popen.return_value.stdout = StringIO.StringIO("error")
+        popen.return_value.wait.return_value = 1
         success, output = utils.executer(
             "testname", "filename")
 
         self.assertFalse(success)
         self.assertEqual(output, "error")
 
+    @mock.patch('os.wait4')
+    @mock.patch('subprocess.Popen')
+    def test_executer_usage(self, popen, wait4):
+        popen.return_value.stdout = StringIO.StringIO("output\n")
+        rusage = mock.Mock(ru_utime=1.5, ru_stime=0.5, ru_maxrss=2048)
+        wait4.return_value = (popen.return_value.pid, 1 << 8, rusage)
+        usage = results.ResourceUsage()
+        success, output = utils.executer("testname", "/dir/filename",
+                                         usage=usage)
+
+        self.assertFalse(success)
+        self.assertEqual(popen.return_value.returncode, 1)
+        wait4.assert_called_with(popen.return_value.pid, 0)
+        self.assertEqual((usage.cpu, usage.max_rss), (2.0, 2048))
+        self.assertTrue(0 <= usage.first_output <= usage.wall)
+
+    def test_usage_table(self):
+        records = [
+            results.TestRecord('fast', True, '', 1.0,
+                               results.ResourceUsage(1.0, 0.5, 0.1, 100,
+                                                     first_output=0.9)),
+            results.TestRecord('slow', True, '', 9.0,
+                               results.ResourceUsage(9.0, 2.0, 0.5, 200,
+                                                     first_output=0.2)),
+            results.TestRecord('batched', False, '', 5.0)]
+        table = utils.usage_table(records, count=2).split('\n')
+
+        slowest = table.index('Slowest tests:')
+        self.assertTrue(table[slowest + 2].endswith('  slow'))
+        self.assertTrue(table[slowest + 3].endswith('  batched'))
+        self.assertEqual(len(table[slowest + 2].split()), 5)
+        overhead = table.index('Highest overhead (time to first output):')
+        self.assertTrue(table[overhead + 2].endswith('  fast'))
+        self.assertTrue(table[overhead + 3].endswith('  slow'))
+
+    def test_bounded_output(self):
+        output = utils.BoundedOutput(max_size=40)
+        for line in range(100):
+            output.write("line %02d\n" % line)
+
+        self.assertEqual(output.getvalue(),
+                         "line 00\nline 01\n"
+                         "\n[... 768 bytes omitted ...]\n"
+                         "line 98\nline 99\n")
+
+    def test_bounded_output_keeps_order(self):
+        output = utils.BoundedOutput(max_size=100)
+        for data in ['a' * 40 + '\n', 'B' * 20 + '\n', 'c\n', 'd\n']:
+            output.write(data)
+
+        self.assertEqual(output.getvalue(),
+                         'a' * 40 + '\n' + 'B' * 20 + '\nc\nd\n')
+
     def test_summary(self):
         dscr = {
             'tempest.api.compute': {'service': 'Compute (Nova)',
@@ -157,6 +236,29 @@ class UtilTest(unittest.TestCase):
             release_name = summary.get('Compute (Nova)').release_name
             self.assertEqual(release_name, 'Essex (or later)')
 
+    def test_summary_longest_prefix(self):
+        summary = utils.service_summary([
+            'tempest.scenario.test_dashboard_basic_ops',
+            'test_list (tempest.api.network.test_networks.NetworksTest)',
+            'nova-extension-os-agents'])
+        self.assertEqual(sorted(summary), ['Compute (Nova)',
+                                           'Dashboard (Horizon)',
+                                           'Network (Neutron)'])
+
+    def test_prefix_trie(self):
+        index = trie.PrefixTrie({'tempest.api.compute': 'compute',
+                                 'tempest.api': 'api',
+                                 'tempest.apx': 'apx',
+                                 'nova-extension': 'nova'})
+        self.assertEqual(index.longest_prefix('tempest.api.compute.x'),
+                         'compute')
+        self.assertEqual(index.longest_prefix('tempest.api.image'), 'api')
+        self.assertEqual(index.longest_prefix('tempest.api'), 'api')
+        self.assertEqual(index.longest_prefix('tempest.apx.y'), 'apx')
+        self.assertEqual(index.longest_prefix('nova-extension-NMN'), 'nova')
+        self.assertEqual(index.longest_prefix('tempest.ap'), None)
+        self.assertEqual(index.longest_prefix('other', 'default'), 'default')
+
     def test_summary_class(self):
         summary = utils.ServiceSummary('servicename')
         self.assertEqual(summary.release_name, '')
@@ -173,8 +275,34 @@ class UtilTest(unittest.TestCase):
         self.assertEqual(str(summary), 'servicename')
         self.assertEqual(summary.features, ['feature', ])
 
-    @mock.patch('novaclient.client')
-    def test_get_smallest_image(self, novaclient):
+    @mock.patch('keystoneclient.v2_0.client.Client')
+    def test_discovery_context(self, keystoneclient):
+        keystone = KeystoneDummy()
+        keystone.auth_ref['serviceCatalog'] = [
+            {'type': 'compute',
+             'endpoints': [{'region': 'one', 'publicURL': 'http://one/'},
+                           {'region': 'two', 'publicURL': 'http://two/'}]}]
+        keystoneclient.return_value = keystone
+
+        context = discover.DiscoveryContext(*self.fake_creds,
+                                            region_name='two')
+        self.assertEqual(keystoneclient.call_count, 1)
+        self.assertEqual(context.token, 'token')
+        self.assertEqual(context.endpoint('compute'), 'http://two/')
+        self.assertRaises(discover.EndpointNotFound,
+                          context.endpoint, 'network')
+
+        with mock.patch.object(context.session, 'get') as get:
+            get.return_value.json.return_value = {'flavors': []}
+            self.assertEqual(context.get('compute', 'flavors/detail'),
+                             {'flavors': []})
+            get.assert_called_with(
+                'http://two/flavors/detail',
+                headers={'X-Auth-Token': 'token',
+                         'Accept': 'application/json'},
+                timeout=discover.TIMEOUT)
+
+    def test_get_smallest_image(self):
         images = []
         images.append(DummyImage(10, 'qcow2', 'ACTIVE'))
         images.append(DummyImage(2, 'qcow2', 'ACTIVE'))
@@ -183,19 +311,43 @@ class UtilTest(unittest.TestCase):
         images.append(DummyImage(0, 'qcow2', 'ACTIVE', id=42,
                                  visibility='private'))
 
-        novaclient_cls = novaclient.get_client_class.return_value
-        novaclient_obj = novaclient_cls.return_value
-        novaclient_obj.images.list.return_value = images
+        context = mock.Mock()
+        context.get.return_value = {'images': images}
 
-        smallest_image = discover.get_smallest_image(*self.fake_creds)
+        smallest_image = discover.get_smallest_image(context)
         self.assertEqual(smallest_image, 42)
+        context.get.assert_called_with('compute', 'images/detail')
+
+    @mock.patch('logging.getLogger')
+    def test_run_probes(self, logger):
+        hang = threading.Event()
+
+        def failing():
+            raise Exception("Service Unavailable")
+
+        probes = {'ok': (lambda x: x * 2, (21, ), None),
+                  'failing': (failing, (), 'default'),
+                  'hanging': (hang.wait, (), 'timeout')}
+        try:
+            results = discover.run_probes(probes, timeout=0.1)
+        finally:
+            hang.set()
+
+        self.assertEqual(results, {'ok': 42,
+                                   'failing': 'default',
+                                   'hanging': 'timeout'})
+        logger.return_value.warning.assert_any_call(
+            "Discovery probe failing failed, using 'default': "
+            "Service Unavailable")
+        logger.return_value.warning.assert_any_call(
+            "Discovery probe hanging timed out after 0.1s, using 'timeout'")
 
     @mock.patch('keystoneclient.v2_0.client.Client')
     def test_create_tenant_and_user(self, keystone):
-        utils.create_tenant_and_user("keystone_username",
-                                     "keystone_password",
-                                     "http://keystone_url",
-                                     "tenant_name")
+        tenants.create_tenant_and_user("keystone_username",
+                                       "keystone_password",
+                                       "http://keystone_url",
+                                       "tenant_name")
 
         keystone.assert_called_with(
             username='keystone_username',
@@ -206,6 +358,7 @@ class UtilTest(unittest.TestCase):
         self.assertTrue(keystone().tenants.create.called)
         self.assertTrue(keystone().users.create.called)
 
+    @mock.patch('tempest_report.discover.DiscoveryContext')
     @mock.patch('tempest_report.discover.get_smallest_flavor')
     @mock.patch('tempest_report.discover.get_smallest_image')
     @mock.patch('tempest_report.discover.get_external_network_id')
@@ -214,7 +367,8 @@ class UtilTest(unittest.TestCase):
                                      get_services,
                                      get_external_network_id,
                                      get_smallest_image,
-                                     get_smallest_flavor):
+                                     get_smallest_flavor,
+                                     context):
 
         get_services.return_value = {'image': 'url'}
         get_external_network_id.return_value = 32
@@ -265,6 +419,149 @@ class UtilTest(unittest.TestCase):
         self.assertIn("admin_tenant_name = \"admin_tenant\"", content)
         self.assertIn("admin_role = \"admin_tenant\"", content)
 
+        users['second_user'] = {'username': 'other', 'password': 'secret',
+                                'tenant_name': 'other_tenant'}
+        content = discover.config_for_users(content, users)
+        self.assertIn("alt_username = other", content)
+        self.assertIn("alt_tenant_name = \"other_tenant\"", content)
+        self.assertIn("allow_tenant_isolation = True", content)
+        self.assertIn("image_ref = 23", content)
+
+    def test_batch_tests(self):
+        tests = ['mod_a:Test.test_1', 'mod_b', 'mod_a:Test.test_2',
+                 'mod_a:Other']
+
+        self.assertEqual(utils.batch_tests(tests),
+                         [('mod_a:Test.test_1', 'mod_a:Test.test_2',
+                           'mod_a:Other'), 'mod_b'])
+        self.assertEqual(utils.batch_tests(tests, batch_size=2),
+                         [('mod_a:Test.test_1', 'mod_a:Test.test_2'),
+                          'mod_a:Other', 'mod_b'])
+        self.assertEqual(utils.batch_tests(tests, 3, by_module=False),
+                         [('mod_a:Test.test_1', 'mod_b', 'mod_a:Test.test_2'),
+                          'mod_a:Other'])
+
+    @mock.patch('os.remove')
+    @mock.patch('os.path.exists')
+    @mock.patch('tempest_report.utils.parse_xunit_file')
+    def test_batch_results(self, parse_xunit_file, exists, remove):
+        exists.return_value = True
+        parse_xunit_file.return_value = [
+            ('mod.Test.test_1', 'ok', 'nova-extension-NMN ... ok\n'),
+            ('mod.Test.test_2', 'FAIL', 'Traceback\n'),
+            ('mod.Other.test_1', 'SKIP', ''),
+        ]
+
+        test_results, missing = utils.batch_results(
+            ('mod:Test.test_1', 'mod:Test', 'mod:Other', 'broken'),
+            "/tmp/report.xml")
+
+        self.assertEqual(test_results, [
+            ('mod:Test.test_1', True, 'nova-extension-NMN ... ok\n'),
+            ('mod:Test', False, 'nova-extension-NMN ... ok\nTraceback\n'),
+            ('mod:Other', True, '')])
+        self.assertEqual(missing, ['broken'])
+        remove.assert_called_once_with("/tmp/report.xml")
+
+        # Without a report no test passes, even if nosetests exited with 0
+        parse_xunit_file.side_effect = IOError(2, 'No such file')
+        self.assertEqual(utils.batch_results(('mod:Test', 'mod:Other'),
+                                             "/tmp/report.xml"),
+                         ([], ['mod:Test', 'mod:Other']))
+
+    @mock.patch('tempest_report.utils.record_result')
+    @mock.patch('tempest_report.utils.start_test')
+    def test_run_supervised_batch(self, start_test, record_result):
+        def start(testname, _configfile, xunit_file=None):
+            if isinstance(testname, tuple):
+                # Only the first test of the batch is in the report
+                with open(xunit_file, 'w') as report:
+                    report.write('<testsuite><testcase classname="mod.Test" '
+                                 'name="test_1"/></testsuite>')
+                return start_shell('echo batch', None)
+            return start_shell('echo alone; exit 1', None)
+
+        start_test.side_effect = start
+        cloud = mock.Mock(durations=None)
+        cloud.acquire_config.return_value = '/tmp/conf'
+        queue = scheduler.Scheduler()
+        queue.put((('mod:Test.test_1', 'mod:Test.test_2'), 'conf'))
+        options = mock.Mock(workers=2, test_timeout=None, verbose=False)
+
+        self.assertTrue(utils.run_supervised(queue, {'conf': cloud}, options))
+
+        recorded = dict((call[0][1], call[0][2:4])
+                        for call in record_result.call_args_list)
+        self.assertEqual(recorded, {
+            'mod:Test.test_1': (True, 'mod.Test.test_1 ... ok\n'),
+            'mod:Test.test_2': (False, 'alone\n')})
+        self.assertEqual(start_test.call_count, 2)
+        self.assertEqual(start_test.call_args[0][:2],
+                         ('mod:Test.test_2', '/tmp/conf'))
+        xunit_file = start_test.call_args_list[0][0][2]
+        self.assertFalse(os.path.exists(xunit_file))
+
+    def test_split_tests(self):
+        test_index = index.TestIndex({
+            'mod.test_a': {'classes': {'A': ['test_1', 'test_2'],
+                                       'B': ['test_3']}},
+            'mod.test_inherited': {'classes': {'C': ['test_4'], 'D': []},
+                                   'bases': {'C': ['object'], 'D': ['C']}},
+            'mod.test_functions': {'classes': {'F': ['test_7']},
+                                   'functions': ['test_8']},
+            'mod.test_short': {'classes': {'E': ['test_5', 'test_6']}}})
+        durations = mock.Mock()
+        durations.expected.side_effect = lambda test: {
+            'mod.test_short': 10}.get(test, 1000)
+        tests = ['mod.test_a', 'mod.test_inherited', 'mod.test_functions',
+                 'mod.test_short', 'mod.test_a:A.test_1', 'mod.test_unknown']
+
+        # The module with inherited tests is split into its classes, the
+        # module with test functions isn't split
+        queued, splits = utils.split_tests(tests, test_index, 'method',
+                                           durations, 600)
+        self.assertEqual(queued, ['mod.test_a:A.test_1', 'mod.test_a:A.test_2',
+                                  'mod.test_a:B.test_3',
+                                  'mod.test_inherited:C',
+                                  'mod.test_inherited:D',
+                                  'mod.test_functions', 'mod.test_short',
+                                  'mod.test_a:A.test_1', 'mod.test_unknown'])
+        self.assertEqual(splits, {'mod.test_a': queued[:3],
+                                  'mod.test_inherited': queued[3:5]})
+
+        queued, splits = utils.split_tests(tests, test_index, 'class',
+                                           durations, 0)
+        self.assertEqual(splits, {'mod.test_a': ['mod.test_a:A',
+                                                 'mod.test_a:B'],
+                                  'mod.test_inherited': queued[2:4],
+                                  'mod.test_short': ['mod.test_short:E']})
+
+        # Without durations nothing is split
+        queued, splits = utils.split_tests(tests, test_index, 'class')
+        self.assertEqual(queued, tests)
+        self.assertEqual(splits, {})
+
+    def test_parse_subtests(self):
+        output = ("test_extensions (tempest_report.tempest_addons."
+                  "NovaExtensionTest) ... nova-extension-NMN ... ok\n"
+                  "nova-extension-OS-DCF ... ok\nok\n"
+                  "cinder-extension-backups ... FAIL\n")
+        self.assertEqual(utils.parse_subtests(output),
+                         ["test_extensions (tempest_report.tempest_addons."
+                          "NovaExtensionTest) ... nova-extension-NMN",
+                          "nova-extension-OS-DCF"])
+
+    @mock.patch('logging.getLogger')
+    def test_stream_line(self, logger):
+        cloud = utils.CloudRun('cloud', 'user', 'password', 'url')
+        utils.stream_line(cloud, 'tempest.test_a',
+                          "nova-extension-OS-DCF ... ok\n")
+
+        logger.return_value.debug.assert_called_with(
+            "tempest.test_a: nova-extension-OS-DCF ... ok")
+        self.assertEqual(cloud.results.successful_subtests,
+                         ["nova-extension-OS-DCF"])
+
     @mock.patch('logging.getLogger')
     @mock.patch('Queue.Queue')
     @mock.patch('tempest_report.utils.executer')
@@ -279,27 +576,21 @@ class UtilTest(unittest.TestCase):
                 return ("testname", "confname")
             raise QueueEmpty()
 
-        successful_tests = []
-        successful_subtests = []
-        junit_tests = []
+        cloud = utils.CloudRun('cloud', 'user', 'password', 'url')
+        cloud.configfile = "confname"
         tempest_report.utils.executer.return_value = (True, "")
         queue.get_nowait.side_effect = side_effect
-        utils.worker(queue, successful_tests, successful_subtests, junit_tests)
+        utils.worker(queue, {'confname': cloud})
 
         queue.get_nowait.assert_called_with()
         logger.assert_called_with('tempest_report')
-        executer.assert_called_with('testname', "confname")
-        self.assertEqual(successful_tests, ["testname"])
-        self.assertEqual(len(junit_tests), 1)
+        executer.assert_called_with('testname', "confname",
+                                    on_line=mock.ANY, usage=mock.ANY)
+        self.assertEqual(cloud.results.successful_tests, ["testname"])
+        self.assertEqual(len(cloud.results.junit_tests()), 1)
         queue.task_done.assert_called_with()
 
-    @mock.patch('keystoneclient.v2_0.client')
-    @mock.patch('os.remove')
-    @mock.patch('tempest_report.utils.customized_tempest_conf')
-    @mock.patch('threading.Thread')
-    @mock.patch('tempest_report.utils.logging')
-    def test_main(self, logger, thread, customized_conf, remove, keystone):
-
+    def main_options(self):
         options = lambda: object
         options.os_username = "username"
         options.os_password = "password"
@@ -310,9 +601,40 @@ class UtilTest(unittest.TestCase):
         options.max_release_level = 10
         options.verbose = False
         options.exclude = None
+        options.exclude_report = None
         options.junit = None
         options.is_admin = False
-
+        options.batch = False
+        options.batch_size = None
+        options.engine = 'subprocess'
+        options.workers = 4
+        options.heavy_limit = None
+        options.history = None
+        options.os_region_name = None
+        options.incremental = False
+        options.inventory = None
+        options.token_cache = None
+        options.fast_discovery = False
+        options.split = 'module'
+        options.split_threshold = 600
+        options.subunit = None
+        options.ndjson = None
+        options.slowest = 10
+        options.test_timeout = None
+        options.deadline = None
+        options.tenant_pool = None
+        return options
+
+    @mock.patch('tempest_report.supervisor.Supervisor')
+    @mock.patch('tempest_report.discover.DiscoveryContext')
+    @mock.patch('keystoneclient.v2_0.client')
+    @mock.patch('os.remove')
+    @mock.patch('tempest_report.utils.customized_tempest_conf')
+    @mock.patch('threading.Thread')
+    @mock.patch('tempest_report.utils.logging')
+    def test_main(self, logger, thread, customized_conf, remove, keystone,
+                  context, supervisor_class):
+        options = self.main_options()
         thread.return_value.isAlive = lambda: False
 
         customized_conf.return_value = "dummy_content"
@@ -324,5 +646,1104 @@ class UtilTest(unittest.TestCase):
 
         logger.getLogger().info.assert_any_call(
             '\nFailed tests:\ntestname')
+        self.assertTrue(supervisor_class.return_value.run.called)
+        self.assertFalse(thread.called)
 
         self.assertTrue(remove.called)
+
+    @mock.patch('tempest_report.supervisor.Supervisor')
+    @mock.patch('tempest_report.discover.DiscoveryContext')
+    @mock.patch('os.remove')
+    @mock.patch('tempest_report.utils.customized_tempest_conf')
+    @mock.patch('tempest_report.utils.logging')
+    def test_main_failed_cloud(self, logger, customized_conf, remove,
+                               context, supervisor_class):
+        inventory = tempfile.NamedTemporaryFile()
+        inventory.write("[cloud1]\n"
+                        "os_username = user1\n"
+                        "os_password = password1\n"
+                        "os_auth_url = http://cloud1:5000/v2.0\n"
+                        "os_tenant_name = tenant1\n"
+                        "[cloud2]\n"
+                        "os_username = user2\n"
+                        "os_password = password2\n"
+                        "os_auth_url = http://cloud2:5000/v2.0\n"
+                        "os_tenant_name = tenant2\n")
+        inventory.flush()
+        options = self.main_options()
+        options.inventory = inventory.name
+
+        def tempest_conf(users, auth_url, **_kwargs):
+            if 'cloud1' in auth_url:
+                raise Exception("Connection refused")
+            return "dummy_content"
+
+        customized_conf.side_effect = tempest_conf
+        with mock.patch.dict(settings.description_list, {'testname': {}},
+                             clear=True):
+            utils.main(options)
+
+        # The tests of the other cloud still ran
+        queue = supervisor_class.call_args[0][0]
+        self.assertEqual(queue.qsize(), 1)
+        self.assertTrue(supervisor_class.return_value.run.called)
+        self.assertEqual(remove.call_count, 1)
+        logger.getLogger().info.assert_any_call(
+            "\nFailed to prepare cloud1, no tests were run: "
+            "Connection refused")
+
+    def test_load_inventory(self):
+        inventory = tempfile.NamedTemporaryFile()
+        inventory.write("[cloud1]\n"
+                        "os_username = user1\n"
+                        "os_password = password1\n"
+                        "os_auth_url = http://cloud1:5000/v2.0\n"
+                        "[cloud2]\n"
+                        "os_username = user2\n"
+                        "os_password = password2\n"
+                        "os_auth_url = http://cloud2:5000/v2.0\n"
+                        "os_tenant_name = tenant2\n"
+                        "os_region_name = region2\n"
+                        "admin = true\n")
+        inventory.flush()
+
+        def options():
+            pass
+        options.is_admin = False
+        clouds = utils.load_inventory(inventory.name, options)
+
+        self.assertEqual([cloud.name for cloud in clouds],
+                         ['cloud1', 'cloud2'])
+        self.assertEqual(clouds[0].username, 'user1')
+        self.assertEqual(clouds[0].tenant_name, None)
+        self.assertFalse(clouds[0].is_admin)
+        self.assertEqual(clouds[1].auth_url, 'http://cloud2:5000/v2.0')
+        self.assertEqual(clouds[1].tenant_name, 'tenant2')
+        self.assertEqual(clouds[1].region_name, 'region2')
+        self.assertTrue(clouds[1].is_admin)
+        self.assertNotEqual(clouds[0].key, clouds[1].key)
+
+
+class PreforkTest(unittest.TestCase):
+
+    def test_run_test_failure(self):
+        success, output = prefork.run_test('tempest_report.nonexisting')
+
+        self.assertFalse(success)
+        self.assertIn('nonexisting', output)
+
+    @mock.patch('tempest_report.prefork.run_test')
+    def test_prefork_executer(self, run_test):
+        run_test.return_value = (True, "nova-extension-NMN ... ok")
+
+        execute = prefork.PreforkExecuter(preload=['json'])
+        execute.start('/dir/tempest.conf')
+        try:
+            success, output = execute('testname', '/dir/tempest.conf')
+        finally:
+            execute.stop()
+
+        self.assertTrue(success)
+        self.assertEqual(output, "nova-extension-NMN ... ok")
+        self.assertEqual(execute.servers, {})
+
+    @mock.patch('tempest_report.prefork.run_test')
+    def test_prefork_timeout(self, run_test):
+        def run(testname):
+            if testname == 'hanging':
+                time.sleep(60)
+            return (True, "ok")
+
+        run_test.side_effect = run
+        execute = prefork.PreforkExecuter(preload=['json'], timeout=0.5)
+        execute.start('/dir/tempest.conf')
+        try:
+            start = time.time()
+            success, output = execute('hanging', '/dir/tempest.conf')
+            self.assertLess(time.time() - start, 5)
+            self.assertFalse(success)
+            self.assertEqual(output, "Test timed out after 0.5s, killed")
+
+            # The server still runs further tests
+            self.assertEqual(execute('testname', '/dir/tempest.conf'),
+                             (True, "ok"))
+        finally:
+            execute.stop()
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_resource_class(self):
+        dscr = {'tempest.scenario.test_dashboard_basic_ops': {},
+                'tempest.scenario.test_large_ops': {'level': 2},
+                'tempest.cli.simple_read_only.test_nova': {'level': 3}}
+
+        with mock.patch.dict(settings.description_list, dscr):
+            self.assertEqual(scheduler.resource_class(
+                'tempest.scenario.test_dashboard_basic_ops'), 'light')
+            self.assertEqual(scheduler.resource_class(
+                'tempest.scenario.test_large_ops'), 'heavy')
+            self.assertEqual(scheduler.resource_class(
+                'tempest.cli.simple_read_only.test_nova'), 'light')
+            self.assertEqual(scheduler.resource_class(
+                'tempest.api.compute.servers.test_servers'), 'heavy')
+
+    def test_service_name(self):
+        self.assertEqual(scheduler.service_name(
+            'tempest.scenario.test_dashboard_basic_ops'),
+            'Dashboard (Horizon)')
+        self.assertEqual(scheduler.service_name(
+            'tempest.scenario.test_large_ops'), 'Scenario')
+        self.assertEqual(scheduler.service_name('unknown'), None)
+
+    def test_scheduler_limits(self):
+        queue = scheduler.Scheduler(class_limits={'heavy': 2},
+                                    service_limits={'Scenario': 1})
+        queue.put(('tempest.scenario.test_a', 'conf'))
+        queue.put(('tempest.scenario.test_b', 'conf'))
+        queue.put(('tempest.cli.simple_read_only.test_nova', 'conf'))
+
+        got = []
+        holding = threading.Event()
+        release = threading.Event()
+
+        def hold_first():
+            got.append(queue.get_nowait())
+            holding.set()
+            release.wait()
+            queue.task_done()
+
+        thread = threading.Thread(target=hold_first)
+        thread.start()
+        holding.wait()
+
+        # The second scenario test is held back by the service limit
+        got.append(queue.get_nowait())
+        queue.task_done()
+        release.set()
+        thread.join()
+        got.append(queue.get_nowait())
+        queue.task_done()
+
+        self.assertEqual([test for test, _conf in got],
+                         ['tempest.scenario.test_a',
+                          'tempest.cli.simple_read_only.test_nova',
+                          'tempest.scenario.test_b'])
+        self.assertRaises(QueueEmpty, queue.get_nowait)
+
+    def test_scheduler_longest_first(self):
+        durations = {'test_a': 1, 'test_b': 30, 'test_c': 10}
+        queue = scheduler.Scheduler()
+        for test in ['test_a', 'test_b', 'test_c']:
+            queue.put((test, 'conf'), durations[test])
+
+        order = []
+        while queue.qsize():
+            order.append(queue.get_nowait()[0])
+            queue.task_done()
+        self.assertEqual(order, ['test_b', 'test_c', 'test_a'])
+
+    def test_scheduler_try_get(self):
+        queue = scheduler.Scheduler(class_limits={'heavy': 1},
+                                    service_limits={})
+        queue.put(('tempest.scenario.test_a', 'conf'))
+        queue.put(('tempest.scenario.test_b', 'conf'))
+
+        self.assertEqual(queue.try_get('one')[0], 'tempest.scenario.test_a')
+        # Held back by the class limit, without blocking
+        self.assertIsNone(queue.try_get('two'))
+        queue.task_done('one')
+        self.assertEqual(queue.try_get('two')[0], 'tempest.scenario.test_b')
+        queue.task_done('two')
+        self.assertRaises(QueueEmpty, queue.try_get, 'three')
+
+
+def start_shell(command, _configfile):
+    return subprocess.Popen(['sh', '-c', command], stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+
+
+class SupervisorTest(unittest.TestCase):
+
+    def run_supervisor(self, commands, **kwargs):
+        queue = scheduler.Scheduler()
+        for command in commands:
+            queue.put((command, 'conf'))
+        lines = []
+        results = {}
+
+        def on_result(item, success, output, duration, usage):
+            results[item[0]] = (success, output, usage)
+
+        runner = supervisor.Supervisor(
+            queue, start_shell, 4,
+            on_line=lambda item, line: lines.append(line),
+            on_result=on_result, **kwargs)
+        return runner, runner.run(), results, lines
+
+    def test_supervisor(self):
+        start = time.time()
+        runner, finished, results, lines = self.run_supervisor(
+            ['echo first; printf partial', 'echo error; exit 1',
+             'sleep 0.2; echo late'])
+
+        self.assertTrue(finished)
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(results['echo first; printf partial'][:2],
+                         (True, 'first\npartial'))
+        self.assertEqual(results['echo error; exit 1'][:2],
+                         (False, 'error\n'))
+        usage = results['sleep 0.2; echo late'][2]
+        self.assertTrue(usage.first_output >= 0.2)
+        self.assertTrue(usage.wall >= usage.first_output)
+        self.assertEqual(sorted(lines), ['error\n', 'first\n', 'late\n',
+                                         'partial'])
+
+    def test_supervisor_test_timeout(self):
+        start = time.time()
+        # The group is killed, including the background sleep
+        runner, finished, results, _lines = self.run_supervisor(
+            ['sleep 30 & echo started; wait', 'echo fast'],
+            test_timeout=0.3, kill_grace=1)
+
+        self.assertTrue(finished)
+        self.assertTrue(time.time() - start < 5)
+        success, output, _usage = results['sleep 30 & echo started; wait']
+        self.assertFalse(success)
+        self.assertEqual(output, 'started\n\nTest timed out after 0.3s, '
+                                 'killed\n')
+        self.assertTrue(results['echo fast'][0])
+
+    def test_supervisor_batch_timeout(self):
+        queue = scheduler.Scheduler()
+        queue.put((('sleep 0.4', 'batched test'), 'conf'))
+        queue.put(('sleep 30', 'conf'))
+        results = {}
+
+        def start(testname, configfile):
+            if isinstance(testname, tuple):
+                testname = testname[0]
+            return start_shell(testname, configfile)
+
+        def on_result(item, success, output, duration, usage):
+            results[item[0]] = (success, output)
+
+        runner = supervisor.Supervisor(queue, start, 2, on_result=on_result,
+                                       test_timeout=0.3, kill_grace=1)
+        self.assertTrue(runner.run())
+        # A batch of two tests gets twice the timeout of a single test
+        self.assertEqual(results[('sleep 0.4', 'batched test')], (True, ''))
+        self.assertEqual(results['sleep 30'],
+                         (False, '\nTest timed out after 0.3s, killed\n'))
+
+    def test_supervisor_deadline(self):
+        commands = ['sleep 30'] * 4 + ['echo never']
+        runner, finished, results, _lines = self.run_supervisor(
+            commands, deadline=time.time() + 0.3, kill_grace=0.1)
+
+        self.assertFalse(finished)
+        self.assertEqual(runner.reason, 'Deadline of the run exceeded')
+        self.assertFalse(results['sleep 30'][0])
+        self.assertNotIn('echo never', results)
+        self.assertEqual(runner.queue.qsize(), 1)
+
+    def test_supervisor_start_error(self):
+        def start(command, _configfile):
+            raise OSError(2, 'No such file or directory')
+
+        queue = scheduler.Scheduler()
+        queue.put(('test', 'conf'))
+        results = []
+        runner = supervisor.Supervisor(
+            queue, start, 1, on_result=lambda *args: results.append(args))
+        self.assertTrue(runner.run())
+        self.assertEqual(results[0][:3], (('test', 'conf'), False,
+                                          'Failed to start test: [Errno 2] '
+                                          'No such file or directory\n'))
+
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'state', 'history.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_duration_history(self):
+        durations = history.DurationHistory(self.path, 'cloud')
+        self.assertEqual(durations.expected('tempest.scenario.test_x'),
+                         history.DEFAULT_DURATIONS['heavy'])
+
+        durations.record('tempest.scenario.test_x', 100)
+        durations.record('tempest.scenario.test_x', 200)
+        durations.save()
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0600)
+
+        durations = history.DurationHistory(self.path, 'cloud')
+        self.assertEqual(durations.expected('tempest.scenario.test_x'), 150)
+        # Unknown tests default to the average of their resource class
+        self.assertEqual(durations.expected('tempest.scenario.test_y'), 150)
+        self.assertEqual(durations.expected(('tempest.scenario.test_x',
+                                             'tempest.cli.test_z')), 160)
+
+        other = history.DurationHistory(self.path, 'other cloud')
+        self.assertEqual(other.durations, {})
+
+    def test_cloud_key(self):
+        key = storage.cloud_key('http://keystone:5000/v2.0', 'tenant')
+        self.assertEqual(len(key), 16)
+        self.assertNotEqual(key, storage.cloud_key('http://keystone:5000/v2.0',
+                                                   'tenant', 'region'))
+
+
+class FingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'results.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_service_type(self):
+        self.assertEqual(fingerprint.service_type(
+            'tempest.api.compute.servers.test_servers'), 'compute')
+        self.assertEqual(fingerprint.service_type(
+            'tempest_report.tempest_addons:GlanceV2Test'), 'image')
+        self.assertEqual(fingerprint.service_type(
+            'tempest.scenario.test_minimum_basic'), None)
+
+    def test_service_fingerprints(self):
+        session = mock.Mock()
+        session.get.return_value.status_code = 200
+        session.get.return_value.json.return_value = {
+            'extensions': [{'alias': 'os-b'}, {'alias': 'os-a'}]}
+
+        services = {'compute': 'http://nova:8774/v2/tenant',
+                    'network': 'http://neutron:9696/'}
+        first = fingerprint.service_fingerprints(services, 'token', session)
+
+        session.get.assert_any_call(
+            'http://nova:8774/v2/tenant/extensions',
+            headers={'X-Auth-Token': 'token', 'Accept': 'application/json'},
+            timeout=30)
+        session.get.assert_any_call(
+            'http://neutron:9696/v2.0/extensions',
+            headers={'X-Auth-Token': 'token', 'Accept': 'application/json'},
+            timeout=30)
+
+        session.get.return_value.json.return_value = {
+            'extensions': [{'alias': 'os-a'}]}
+        second = fingerprint.service_fingerprints(services, 'token', session)
+        self.assertNotEqual(first['compute'], second['compute'])
+
+    def test_result_cache(self):
+        fingerprints = {'compute': 'abc', 'volume': 'def', 'image': None}
+        results = fingerprint.ResultCache(self.path, fingerprints)
+        self.assertFalse(results.unchanged('tempest.api.compute.test_a'))
+        results.add('tempest.api.compute.test_a', True, 'output', ['sub'])
+        results.add('tempest.api.volume.test_b', True, 'output', [])
+        results.add('tempest.api.image.test_c', True, 'output', [])
+        results.save()
+
+        fingerprints = {'compute': 'abc', 'volume': 'changed', 'image': None}
+        results = fingerprint.ResultCache(self.path, fingerprints)
+        self.assertTrue(results.unchanged('tempest.api.compute.test_a'))
+        self.assertFalse(results.unchanged('tempest.api.volume.test_b'))
+        self.assertFalse(results.unchanged('tempest.api.image.test_c'))
+        self.assertEqual(results.get('tempest.api.compute.test_a'),
+                         (True, '', ['sub']))
+
+    def test_result_cache_reruns_failures(self):
+        fingerprints = {'compute': 'abc'}
+        results = fingerprint.ResultCache(self.path, fingerprints)
+        results.add('tempest.api.compute.test_a', False, 'error', ['sub'])
+        results.save()
+
+        # Failed tests run again while the service is unchanged
+        results = fingerprint.ResultCache(self.path, fingerprints)
+        self.assertFalse(results.unchanged('tempest.api.compute.test_a'))
+
+        # Also with failures stored by former versions
+        storage.save_json(self.path, {
+            'fingerprints': fingerprints,
+            'tests': {'tempest.api.compute.test_a': {
+                'success': False, 'output': 'error', 'subtests': []}}})
+        results = fingerprint.ResultCache(self.path, fingerprints)
+        self.assertFalse(results.unchanged('tempest.api.compute.test_a'))
+
+
+class TenantPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'tenants.json')
+        self.created = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def keystone(self):
+        keystone = mock.Mock()
+        lock = threading.Lock()
+
+        def create_tenant(tenant_name, **_kwargs):
+            with lock:
+                self.created.append(tenant_name)
+                return mock.Mock(id='tenant-%d' % len(self.created))
+
+        keystone.tenants.create.side_effect = create_tenant
+        keystone.users.create.side_effect = lambda *args: mock.Mock(
+            id='user-%s' % args[3])
+        return keystone
+
+    def pool(self, path):
+        return tenants.TenantPool(path, 'cloud', 'admin', 'password',
+                                  'http://keystone', 'admin')
+
+    def stored(self):
+        with open(self.path) as stored:
+            return json.load(stored)['cloud']
+
+    @mock.patch('tempest_report.auth.get_client')
+    def test_tenant_pool(self, get_client):
+        keystone = get_client.return_value = self.keystone()
+        pool = self.pool(self.path)
+        users = pool.acquire(3)
+        self.assertEqual(len(self.created), 3)
+        self.assertEqual(sorted(user['tenant_id'] for user in users),
+                         ['tenant-1', 'tenant-2', 'tenant-3'])
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0600)
+        pool.release()
+        self.assertFalse(keystone.users.delete.called)
+
+        # A later run reuses the valid users and replaces the others.
+        # Rejected users are deleted, users which couldn't be checked are
+        # kept for later runs.
+        invalid = users[0]
+        unchecked = users[1]
+
+        def authenticate(username, *args):
+            if username == invalid['username']:
+                raise keystoneclient.exceptions.Unauthorized()
+            if username == unchecked['username']:
+                raise keystoneclient.exceptions.ServiceUnavailable()
+            return keystone
+
+        get_client.side_effect = authenticate
+        pool = self.pool(self.path)
+        reused = pool.acquire(4)
+        self.assertEqual(len(self.created), 6)
+        self.assertEqual(reused[0], users[2])
+        self.assertNotIn(invalid, reused)
+        self.assertNotIn(unchecked, reused)
+        self.assertIn(unchecked, self.stored())
+        self.assertNotIn(invalid['user_id'],
+                         [user['user_id'] for user in self.stored()])
+        keystone.users.delete.assert_called_once_with(invalid['user_id'])
+        keystone.tenants.delete.assert_called_once_with(invalid['tenant_id'])
+
+        # Kept for later runs
+        pool.release()
+        self.assertEqual(keystone.users.delete.call_count, 1)
+        self.assertEqual(len(self.stored()), 5)
+
+    @mock.patch('tempest_report.auth.get_client')
+    def test_tenant_pool_leases(self, get_client):
+        get_client.return_value = self.keystone()
+        first = self.pool(self.path)
+        first_users = first.acquire(2)
+
+        # A concurrent run doesn't share the leased pairs
+        second = self.pool(self.path)
+        second_users = second.acquire(2)
+        self.assertEqual(len(self.created), 4)
+        self.assertFalse(set(user['user_id'] for user in first_users) &
+                         set(user['user_id'] for user in second_users))
+
+        # Released pairs and pairs of runs which died are reused
+        first.release()
+        stored = self.stored()
+        for user in stored:
+            if user['user_id'] == second_users[0]['user_id']:
+                user['lease'] = '%s:%d' % (socket.gethostname(), 2 ** 22 + 1)
+        storage.save_json(self.path, {'cloud': stored})
+        third = self.pool(self.path)
+        third_users = third.acquire(3)
+        self.assertEqual(len(self.created), 4)
+        self.assertEqual(sorted(third_users, key=lambda user: user['user_id']),
+                         sorted(first_users + second_users[:1],
+                                key=lambda user: user['user_id']))
+
+    @mock.patch('tempest_report.auth.get_client')
+    def test_tenant_pool_without_path(self, get_client):
+        get_client.return_value = self.keystone()
+        pool = self.pool(None)
+        users = pool.acquire(2)
+        pool.release()
+
+        self.assertEqual(sorted(call[0][0] for call in get_client.return_value
+                                .users.delete.call_args_list),
+                         sorted(user['user_id'] for user in users))
+        self.assertEqual(get_client.return_value.tenants.delete.call_count,
+                         2)
+
+    @mock.patch('tempest_report.auth.get_client')
+    def test_tenant_pool_creation_failure(self, get_client):
+        keystone = get_client.return_value = self.keystone()
+
+        def create_user(*args):
+            if args[3] == 'tenant-2':
+                raise keystoneclient.exceptions.ServiceUnavailable()
+            return mock.Mock(id='user-%s' % args[3])
+
+        keystone.users.create.side_effect = create_user
+        pool = self.pool(None)
+        self.assertRaises(keystoneclient.exceptions.ServiceUnavailable,
+                          pool.acquire, 3)
+
+        # The tenant of the failed user is deleted right away, the other
+        # pairs once the pool is released
+        self.assertEqual(len(pool.users), 2)
+        pool.release()
+        self.assertEqual(sorted(call[0][0] for call in
+                                keystone.tenants.delete.call_args_list),
+                         ['tenant-1', 'tenant-2', 'tenant-3'])
+        self.assertEqual(keystone.users.delete.call_count, 2)
+
+    @mock.patch('tempest_report.utils.customized_tempest_conf')
+    @mock.patch('tempest_report.discover.DiscoveryContext')
+    @mock.patch('tempest_report.tenants.TenantPool')
+    def test_worker_configs(self, pool, context, customized_conf):
+        pairs = [{'username': 'user%d' % nr, 'password': 'password',
+                  'tenant_name': 'tenant%d' % nr} for nr in range(3)]
+        pool.return_value.acquire.return_value = pairs
+        customized_conf.return_value = (
+            "[identity]\nusername = user0\n[compute]\n")
+
+        def options():
+            pass
+        options.tenant_pool = self.path
+        options.workers = 3
+        options.history = None
+        options.incremental = False
+        options.fast_discovery = False
+        cloud = utils.CloudRun('cloud', 'admin', 'password', 'url', 'admin',
+                               is_admin=True)
+        utils.prepare_cloud(cloud, options, ['test'])
+
+        try:
+            self.assertEqual(len(cloud.configfiles), 3)
+            configs = [cloud.acquire_config() for _nr in range(3)]
+            self.assertEqual(configs, cloud.configfiles)
+            with open(configs[2]) as config:
+                content = config.read()
+            self.assertIn("username = user2", content)
+            self.assertIn("alt_username = user0", content)
+
+            cloud.release_config(configs[1])
+            self.assertEqual(cloud.acquire_config(), configs[1])
+        finally:
+            utils.finish_cloud(cloud)
+        self.assertFalse(any(os.path.exists(configfile)
+                             for configfile in cloud.configfiles))
+        self.assertTrue(pool.return_value.release.called)
+
+
+class FleetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_feature_index(self):
+        index = fleet.FeatureIndex()
+        passed = ['tempest.api.object_storage.test_container_quotas',
+                  'tempest.api.object_storage.test_object_version',
+                  'nova-extension-NMN', 'tempest.unknown']
+        bits = index.bitset(passed)
+
+        # Same result as the summary of a single run
+        services = utils.service_summary(passed)
+        self.assertEqual(index.services(bits),
+                         sorted(name for name in services
+                                if name in index.service_masks))
+        for name in index.services(bits):
+            self.assertEqual(index.release(bits, name),
+                             services[name].release)
+        self.assertEqual(index.features(bits),
+                         sorted((name, feature)
+                                for name, service in services.items()
+                                for feature in service.get_features()))
+        self.assertRaises(KeyError, index.feature_mask, 'unknown')
+
+    def write_report(self, name, cloud, started, passed):
+        path = os.path.join(self.tempdir, name)
+        writer = reporters.NDJSONWriter(path, cloud, started)
+        for testname in passed[:1]:
+            writer.add(results.TestRecord(testname, True, 'ok', 1.0))
+        writer.add_summary({}, passed[1:])
+        writer.close()
+        return path
+
+    def test_fleet(self):
+        description_list = {
+            'tempest.api.compute.test_a': {'feature': 'A', 'release': 6},
+            'tempest.api.compute.test_b': {'feature': 'B', 'release': 8},
+            'nova-extension-C': {'feature': 'C', 'release': 7}}
+        aggregate = fleet.Fleet(fleet.FeatureIndex(description_list))
+        old = datetime.datetime(2014, 1, 1)
+        new = datetime.datetime(2014, 2, 1)
+
+        aggregate.load_report(self.write_report(
+            'one-old.ndjson', 'one', old,
+            ['tempest.api.compute.test_a', 'tempest.api.compute.test_b']))
+        aggregate.load_report(self.write_report(
+            'one-new.ndjson', 'one', new,
+            ['tempest.api.compute.test_a', 'nova-extension-C']))
+        aggregate.load_report(self.write_report(
+            'two.ndjson', 'two', old, ['tempest.api.compute.test_b']))
+        # Interrupted run without a run record
+        path = os.path.join(self.tempdir, 'three.ndjson')
+        with open(path, 'w') as report:
+            report.write('{"type": "test", "id": "nova-extension-C", '
+                         '"status": "success"}\n{"type": "te')
+        aggregate.load_report(path)
+
+        self.assertEqual(len(aggregate.runs), 4)
+        self.assertEqual(aggregate.missing('B'), ['one', 'three'])
+        self.assertEqual(aggregate.missing('A', 'Compute (Nova)'),
+                         ['three', 'two'])
+        self.assertEqual(aggregate.coverage(),
+                         {('Compute (Nova)', 'A'): 1,
+                          ('Compute (Nova)', 'B'): 1,
+                          ('Compute (Nova)', 'C'): 2})
+        self.assertEqual(aggregate.releases(),
+                         {'Compute (Nova)': {7: 2, 8: 1}})
+        self.assertIn("\t\t\t\tC%s 2/3" % (' ' * 31),
+                      fleet.summary(aggregate))
+
+
+class AuthTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'tokens.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def auth_ref(self, expires_in):
+        expires = datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=expires_in)
+        return {'version': 'v2.0',
+                'token': {'id': 'token',
+                          'expires': expires.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                          'tenant': {'id': 'tenant_id', 'name': 'tenant'}},
+                'user': {'id': 'user_id', 'name': 'user'},
+                'serviceCatalog': [
+                    {'type': 'identity',
+                     'endpoints': [{'publicURL': 'http://keystone:5000/',
+                                    'adminURL': 'http://keystone:35357/'}]}]}
+
+    @mock.patch('keystoneclient.v2_0.client.Client')
+    def test_token_cache(self, keystoneclient):
+        keystoneclient.return_value.auth_ref = AccessInfo.factory(
+            **self.auth_ref(3600))
+        cache = auth.TokenCache(self.path)
+
+        cache.client('user', 'password', 'http://keystone:5000/', 'tenant')
+        keystoneclient.assert_called_with(username='user',
+                                          password='password',
+                                          auth_url='http://keystone:5000/',
+                                          tenant_name='tenant')
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0600)
+
+        cache.client('user', 'password', 'http://keystone:5000/', 'tenant')
+        auth_ref = keystoneclient.call_args[1]['auth_ref']
+        self.assertEqual(auth_ref['token']['id'], 'token')
+
+        # Another tenant doesn't share the token
+        self.assertEqual(cache.get('http://keystone:5000/', 'user',
+                                   'password', 'other'), None)
+
+        # Neither does another password, which isn't stored
+        cache.client('user', 'changed', 'http://keystone:5000/', 'tenant')
+        keystoneclient.assert_called_with(username='user',
+                                          password='changed',
+                                          auth_url='http://keystone:5000/',
+                                          tenant_name='tenant')
+        with open(self.path) as cached:
+            self.assertNotIn('password', cached.read())
+
+    def test_token_cache_expiry(self):
+        cache = auth.TokenCache(self.path)
+        cache.add('http://keystone:5000/', 'user', 'password', 'tenant',
+                  self.auth_ref(3600))
+        cache.add('http://keystone:5000/', 'user', 'password', 'soon',
+                  self.auth_ref(60))
+        self.assertNotEqual(
+            cache.get('http://keystone:5000/', 'user', 'password', 'tenant'),
+            None)
+        self.assertEqual(
+            cache.get('http://keystone:5000/', 'user', 'password', 'soon'),
+            None)
+        # The token is only reused with the same password
+        self.assertEqual(
+            cache.get('http://keystone:5000/', 'user', 'other', 'tenant'),
+            None)
+        self.assertEqual(len(storage.load_json(self.path)), 1)
+
+
+class ExtensionsTest(unittest.TestCase):
+
+    def test_fast_discovery(self):
+        responses = {
+            ('compute', 'extensions', 'publicURL'):
+            {'extensions': [{'alias': 'os-agents'}, {'alias': 'NMN'}]},
+            ('identity', 'extensions', 'publicURL'):
+            {'extensions': {'values': [{'alias': 'OS-KSCRUD'}]}},
+            ('metering', 'v2/meters', 'publicURL'):
+            [{'name': 'cpu'}, {'name': 'cpu'}],
+        }
+
+        def get(service_type, path, interface='publicURL'):
+            if (service_type, path, interface) not in responses:
+                raise discover.EndpointNotFound(service_type)
+            return responses[(service_type, path, interface)]
+
+        context = mock.Mock()
+        context.get.side_effect = get
+
+        prefix = 'tempest_report.tempest_addons:'
+        outputs = extensions.fast_discovery(
+            context, [prefix + 'NovaExtensionTest',
+                      prefix + 'NeutronExtensionTest',
+                      prefix + 'KeystoneExtensionTest',
+                      prefix + 'CeilometerTest',
+                      'tempest.api.compute.test_x'])
+
+        self.assertEqual(outputs, {
+            prefix + 'NovaExtensionTest':
+            'nova-extension-NMN ... ok\nnova-extension-os-agents ... ok\n',
+            prefix + 'KeystoneExtensionTest':
+            'keystone-extension-OS-KSCRUD ... ok\n',
+            prefix + 'CeilometerTest': 'ceilometer-meter-cpu ... ok\n'})
+        self.assertEqual(
+            utils.parse_subtests(outputs[prefix + 'KeystoneExtensionTest']),
+            ['keystone-extension-OS-KSCRUD'])
+
+
+class ResultStoreTest(unittest.TestCase):
+
+    def test_result_store(self):
+        store = results.ResultStore()
+        store.add('tempest.api.b', True, 'output b', 1.5)
+        store.add('tempest.api.a', False, 'output a')
+        store.add_subtests(['nova-extension-b', 'nova-extension-a'])
+        store.add_subtests([u'nova-extension-b'])
+
+        self.assertIn('tempest.api.a', store)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.successful_tests, ['tempest.api.b'])
+        self.assertEqual(store.successful_subtests,
+                         ['nova-extension-b', 'nova-extension-a'])
+        self.assertEqual(store.failed_tests(['tempest.api.a',
+                                             'tempest.api.b',
+                                             'tempest.api.c']),
+                         ['tempest.api.a', 'tempest.api.c'])
+        self.assertEqual(store.junit_tests(),
+                         [('tempest.api.b', 'output b', True),
+                          ('tempest.api.a', 'output a', False)])
+
+        store.add('mod:A.test_1', True, 'one\n', 1,
+                  usage=results.ResourceUsage(1, 0.5, 0.5, 100, 0.25))
+        store.add('mod:A.test_2', True, 'two\n', 2,
+                  usage=results.ResourceUsage(2, 1, 0.5, 300, 0.5))
+        record = store.merge('mod', ['mod:A.test_1', 'mod:A.test_2'])
+        self.assertEqual((record.success, record.output, record.duration),
+                         (True, 'one\ntwo\n', 3))
+        self.assertEqual(record.usage.as_dict(),
+                         {'wall': 3, 'user': 1.5, 'sys': 1.0, 'max_rss': 300,
+                          'first_output': 0.75})
+        self.assertNotIn('mod:A.test_1', store)
+        self.assertFalse(store.merge('other', ['other:B']).success)
+
+        # A rerun replaces the former result
+        store.add('tempest.api.b', False, 'failed')
+        self.assertEqual(store.successful_tests, ['mod'])
+        self.assertEqual(len(store), 4)
+
+
+class ExcludeTest(unittest.TestCase):
+
+    def test_aho_corasick(self):
+        automaton = exclude.AhoCorasick(['he', 'she', 'his', 'hers'])
+        self.assertEqual(automaton.search('ushers'), set([0, 1, 3]))
+        self.assertEqual(automaton.search('xyz'), set())
+
+    def test_exclude_matcher(self):
+        exclude_file = tempfile.NamedTemporaryFile()
+        exclude_file.write("# comment\n"
+                           "test_cinder.CinderTest.test_list\n"
+                           "test_vpnaas_extensions\n"
+                           "^tempest\\.scenario\\..*(volume|image)\n"
+                           "tempest\\.thirdparty\n"
+                           "never_matched$\n")
+        exclude_file.flush()
+        excluded = utils.load_excluded_tests(exclude_file.name)
+
+        self.assertTrue(utils.test_is_excluded(
+            'tempest.cli.test_cinder:CinderTest.test_list', excluded))
+        self.assertEqual(excluded.match(
+            'tempest.api.network.test_vpnaas_extensions'), 3)
+        self.assertEqual(excluded.match(
+            'tempest.scenario.test_volume_boot_pattern'), 4)
+        self.assertEqual(excluded.match('tempest.thirdparty.boto'), 5)
+        self.assertFalse(utils.test_is_excluded(
+            'tempest.scenario.test_server_basic_ops', excluded))
+
+        report = excluded.report()
+        self.assertIn("# line 3: test_vpnaas_extensions (1 tests)\n"
+                      "tempest.api.network.test_vpnaas_extensions\n", report)
+        self.assertIn("# line 6: never_matched$ (0 tests, unused)\n",
+                      report)
+
+        self.assertFalse(utils.test_is_excluded(
+            'tempest.api', utils.load_excluded_tests(None)))
+
+
+class IndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.package = os.path.join(self.tempdir, 'tempest')
+        self.cache = os.path.join(self.tempdir, 'index.json')
+        for directory in ['api', 'api/compute', 'notpackage']:
+            os.makedirs(os.path.join(self.package, directory))
+        self.write('__init__.py', '')
+        self.write('api/__init__.py', '')
+        self.write('api/compute/__init__.py', '')
+        self.write('api/compute/test_servers.py',
+                   "import nonexisting\n"
+                   "class ServersTest(Base):\n"
+                   "    def setUp(self):\n"
+                   "        pass\n"
+                   "    def test_list(self):\n"
+                   "        pass\n"
+                   "    def test_create(self):\n"
+                   "        pass\n")
+        self.write('api/compute/broken.py', "class (\n")
+        self.write('notpackage/test_other.py', '')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, name, content):
+        with open(os.path.join(self.package, name), 'w') as fileobj:
+            fileobj.write(content)
+
+    def test_index(self):
+        tests = index.load_index(self.package, cache_path=self.cache,
+                                 version='1.0')
+        self.assertEqual(tests.module_names(),
+                         ['tempest.api', 'tempest.api.compute',
+                          'tempest.api.compute.broken',
+                          'tempest.api.compute.test_servers'])
+        self.assertEqual(tests.methods('tempest.api.compute.test_servers'),
+                         ['tempest.api.compute.test_servers:'
+                          'ServersTest.test_list',
+                          'tempest.api.compute.test_servers:'
+                          'ServersTest.test_create'])
+        self.assertEqual(tests.methods('tempest.api.compute.broken'), [])
+
+        with mock.patch('tempest_report.index.parse_module') as parse:
+            index.load_index(self.package, cache_path=self.cache,
+                             version='1.0')
+            self.assertFalse(parse.called)
+
+            parse.return_value = {}
+            index.load_index(self.package, cache_path=self.cache,
+                             version='2.0')
+            self.assertEqual(parse.call_count, 4)
+
+    def test_inherited_tests(self):
+        self.write('api/compute/test_keypairs.py',
+                   "from tempest.api.compute import base\n"
+                   "class KeyPairsTest(base.BaseComputeTest):\n"
+                   "    def test_create(self):\n"
+                   "        pass\n")
+        self.write('api/compute/test_keypairs_v22.py',
+                   "import testtools\n"
+                   "from tempest.api.compute import test_keypairs as kp\n"
+                   "class KeyPairsV22Test(kp.KeyPairsTest):\n"
+                   "    def test_create_v22(self):\n"
+                   "        pass\n"
+                   "class OtherTest(testtools.TestCase):\n"
+                   "    def test_other(self):\n"
+                   "        pass\n")
+        self.write('api/compute/base.py',
+                   "class BaseComputeTest(object):\n"
+                   "    def setUp(self):\n"
+                   "        pass\n")
+        self.write('api/compute/test_functions.py',
+                   "def test_function():\n"
+                   "    pass\n")
+        tests = index.load_index(self.package, version='1.0')
+
+        self.assertEqual(
+            tests.modules['tempest.api.compute.test_keypairs_v22']['bases'],
+            {'KeyPairsV22Test': ['tempest.api.compute.test_keypairs.'
+                                 'KeyPairsTest'],
+             'OtherTest': ['testtools.TestCase']})
+        self.assertTrue(tests.inherits_tests(
+            'tempest.api.compute.test_keypairs_v22'))
+        self.assertFalse(tests.inherits_tests(
+            'tempest.api.compute.test_keypairs'))
+        # Unknown base classes of the package might define tests
+        self.assertTrue(tests.inherits_tests(
+            'tempest.api.compute.test_servers'))
+        self.assertEqual(tests.functions('tempest.api.compute.test_functions'),
+                         ['test_function'])
+
+
+class ReportersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'junit.xml')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_junit_writer(self):
+        writer = reporters.JUnitWriter(self.path, 'title "1"')
+        self.assertEqual(ElementTree.parse(self.path).getroot().get('tests'),
+                         '0')
+
+        writer.add(results.TestRecord('test_a', True, 'ok', 1.5))
+        writer.add(results.TestRecord(u'test_b', False, u'<error> \xe9', 2))
+        # The file is complete before the writer is closed
+        suite = ElementTree.parse(self.path).getroot()
+        self.assertEqual(suite.get('name'), 'title "1"')
+        self.assertEqual((suite.get('tests'), suite.get('failures'),
+                          suite.get('time')), ('2', '1', '3.500'))
+        testcases = suite.findall('testcase')
+        self.assertEqual([(case.get('name'), case.get('time'))
+                          for case in testcases],
+                         [('test_a', '1.500'), ('test_b', '2.000')])
+        self.assertEqual(testcases[1].find('failure').text.strip(),
+                         u'<error> \xe9')
+        writer.close()
+
+    @unittest.skipIf(reporters.subunit is None, "requires python-subunit")
+    def test_subunit_writer(self):
+        import subunit
+        import testtools
+
+        writer = reporters.SubunitWriter(self.path)
+        writer.add(results.TestRecord('test_a', True, 'ok', 1.5))
+        writer.add(results.TestRecord('test_b', False, u'error \xe9'))
+        writer.close()
+
+        tests = []
+        with open(self.path, 'rb') as stream:
+            case = subunit.ByteStreamToStreamResult(stream)
+            result = testtools.StreamToDict(tests.append)
+            result.startTestRun()
+            case.run(result)
+            result.stopTestRun()
+
+        self.assertEqual([(test['id'], test['status']) for test in tests],
+                         [('test_a', 'success'), ('test_b', 'fail')])
+        self.assertEqual(tests[1]['details']['stdout'].as_text(),
+                         u'error \xe9')
+        start, end = tests[0]['timestamps']
+        self.assertEqual((end - start).total_seconds(), 1.5)
+
+    def test_junit_writer_usage(self):
+        writer = reporters.JUnitWriter(self.path, 'title')
+        usage = results.ResourceUsage(2.0, 1.0, 0.5, 1024, first_output=0.5)
+        writer.add(results.TestRecord('test_a', True, 'ok', 2.0, usage))
+        writer.add(results.TestRecord('test_b', False, 'error', 1.0, usage))
+        writer.close()
+
+        testcases = ElementTree.parse(self.path).getroot().findall('testcase')
+        properties = dict((prop.get('name'), prop.get('value')) for prop in
+                          testcases[0].findall('properties/property'))
+        self.assertEqual(properties, {'wall': '2.0', 'user': '1.0',
+                                      'sys': '0.5', 'max_rss': '1024',
+                                      'first_output': '0.5'})
+        self.assertIsNone(testcases[0].find('failure'))
+        self.assertEqual(testcases[1].find('failure').text.strip(), 'error')
+        self.assertEqual(len(testcases[1].findall('properties/property')), 5)
+
+    def test_ndjson_writer(self):
+        testname = 'tempest.api.object_storage.test_container_quotas'
+        writer = reporters.NDJSONWriter(self.path, 'cloud',
+                                        datetime.datetime(2014, 5, 1))
+        writer.add(results.TestRecord(testname, True, 'ok', 1.5))
+        writer.add(results.TestRecord('test_b', False, 'error'))
+        writer.add_summary(utils.service_summary([testname]),
+                           [testname, 'nova-extension-NMN'])
+        writer.close()
+
+        with open(self.path) as report:
+            records = [json.loads(line) for line in report]
+        self.assertEqual(records.pop(0), {'type': 'run', 'cloud': 'cloud',
+                                          'started': '2014-05-01T00:00:00'})
+        self.assertEqual(records[0], {
+            'type': 'test', 'id': testname, 'status': 'success',
+            'duration': 1.5, 'service': 'Object Storage (Swift)',
+            'feature': 'Container Quota', 'release': 7, 'usage': None})
+        self.assertEqual((records[1]['status'], records[1]['feature']),
+                         ('fail', None))
+        self.assertEqual(records[2]['type'], 'summary')
+        self.assertEqual(records[2]['services']['Object Storage (Swift)'], {
+            'release': 7, 'release_name':
+            settings.name_mapping.get(7, ''), 'features': ['Container Quota']})
+        self.assertEqual(records[2]['passed'], ['nova-extension-NMN',
+                                                testname])
+
+    def test_gen_junit_file(self):
+        utils.gen_junit_file(self.path, 'title', [('test_a', 'output', True),
+                                                  ('test_b', 'error', False)])
+        suite = ElementTree.parse(self.path).getroot()
+        self.assertEqual(suite.get('failures'), '1')
+        self.assertEqual(len(suite.findall('testcase')), 2)
+
+
+class SpoolTest(unittest.TestCase):
+
+    def test_spool(self):
+        segments = spool.Spool(threshold=20, excerpt_size=4)
+        self.assertEqual(segments.store('small'), 'small')
+
+        output = segments.store('line 1\nline 2\n' + 'x' * 20 + '\nend')
+        self.assertTrue(isinstance(output, spool.SpooledOutput))
+        self.assertEqual(len(output), 38)
+        self.assertEqual(str(output),
+                         "line\n[... 30 bytes omitted ...]\n\nend")
+        self.assertEqual(list(spool.lines(output)),
+                         ['line 1', 'line 2', 'x' * 20, 'end'])
+        self.assertEqual(''.join(output.chunks(chunk_size=5)),
+                         output.getvalue())
+        self.assertTrue(segments.store(output) is output)
+
+        joined = segments.join([output, u'\xe9'])
+        self.assertEqual(joined.getvalue(), output.getvalue() + '\xc3\xa9')
+        self.assertEqual(segments.join(['a', u'b']), 'ab')
+        segments.close()
+
+    def test_result_store_spools_outputs(self):
+        store = results.ResultStore()
+        store.spool = spool.Spool(threshold=10)
+        store.add('test_a', False, 'x' * 11 + '\nsub ... ok\n')
+        output = store.records['test_a'].output
+        self.assertTrue(isinstance(output, spool.SpooledOutput))
+        self.assertEqual(utils.parse_subtests(output), ['sub'])
+        store.close()